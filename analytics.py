@@ -0,0 +1,100 @@
+import streamlit as st
+from firebase_admin import firestore
+import pandas as pd
+
+from compression import inflate
+import repository
+
+TIMEZONE = "Europe/London"
+MESSAGE_COLUMNS = ['timestamp', 'role', 'content', 'content_z']
+DISPLAY_COLUMNS = ['date', 'time', 'role', 'content', 'length', 'response_time']
+
+
+def messages_to_frame(messages, tz=TIMEZONE):
+    """Load message dicts into a columnar frame with per-message metrics"""
+    raw = pd.DataFrame.from_records(list(messages), columns=MESSAGE_COLUMNS)
+    timestamps = pd.to_datetime(raw['timestamp'], utc=True, errors='coerce').dt.tz_convert(tz)
+    content = raw['content'].fillna('').astype(str)
+    # Only long bodies are stored compressed; inflate just those rows
+    compressed = raw['content_z'].notna()
+    content[compressed] = raw.loc[compressed, 'content_z'].map(lambda data: inflate(bytes(data)))
+
+    # Latency is measured against the previous timestamped message, so gaps
+    # across midnight or several days come out as real elapsed seconds
+    timed = timestamps.dropna()
+    response_time = timed.diff().dt.total_seconds().reindex(raw.index)
+
+    return pd.DataFrame({
+        'timestamp': timestamps,
+        'date': timestamps.dt.strftime('%Y-%m-%d').fillna('N/A'),
+        'time': timestamps.dt.strftime('%H:%M:%S').fillna('N/A'),
+        'role': raw['role'].fillna('N/A'),
+        'content': content,
+        'length': content.str.count(r'\S+'),
+        'response_time': response_time
+    })
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def load_conversation_frame(conversation_id, version=None):
+    """Fetch a conversation's messages as a frame, cached per conversation.
+
+    `version` should change whenever the conversation does (its `updated_at`)
+    so new messages invalidate the cached frame.
+    """
+    return messages_to_frame(repository.get_messages(firestore.client(), conversation_id))
+
+
+def summarize_sessions(frames):
+    """Aggregate per-session turns, duration, words and latency.
+
+    `frames` maps conversation id to a frame from `messages_to_frame`; the
+    result has one row per conversation. Cohort-level figures come from the
+    engagement rollups instead (see rollups.py), which need no message reads.
+    """
+    columns = ['started', 'ended', 'messages', 'turns', 'words', 'student_words',
+               'median_response_time', 'duration_minutes']
+    frames = {conv_id: frame for conv_id, frame in frames.items() if not frame.empty}
+    if not frames:
+        return pd.DataFrame(columns=columns).rename_axis('conversation_id')
+
+    df = pd.concat(frames, names=['conversation_id', None]).reset_index(level=0)
+    is_user = df['role'].eq('user')
+    df = df.assign(turn=is_user, student_words=df['length'].where(is_user, 0))
+
+    summary = df.groupby('conversation_id', sort=False).agg(
+        started=('timestamp', 'min'),
+        ended=('timestamp', 'max'),
+        messages=('role', 'size'),
+        turns=('turn', 'sum'),
+        words=('length', 'sum'),
+        student_words=('student_words', 'sum'),
+        median_response_time=('response_time', 'median')
+    )
+    summary['duration_minutes'] = (summary['ended'] - summary['started']).dt.total_seconds() / 60
+    return summary[columns]
+
+
+def summarize_spans(events):
+    """Latency percentiles and token totals per span name and intent"""
+    columns = ['count', 'p50_ms', 'p95_ms', 'p99_ms', 'prompt_tokens', 'completion_tokens', 'cached_tokens']
+    df = pd.DataFrame.from_records(list(events))
+    if df.empty:
+        return pd.DataFrame(columns=['name', 'intent'] + columns)
+
+    df['intent'] = df.get('intent', pd.Series(index=df.index, dtype=object)).fillna('')
+    for column in ['prompt_tokens', 'completion_tokens', 'cached_tokens']:
+        df[column] = pd.to_numeric(df.get(column), errors='coerce')
+
+    grouped = df.groupby(['name', 'intent'])
+    durations = grouped['duration_ms'].quantile([0.5, 0.95, 0.99]).unstack()
+    summary = pd.DataFrame({
+        'count': grouped.size(),
+        'p50_ms': durations[0.5],
+        'p95_ms': durations[0.95],
+        'p99_ms': durations[0.99],
+        'prompt_tokens': grouped['prompt_tokens'].sum(min_count=1),
+        'completion_tokens': grouped['completion_tokens'].sum(min_count=1),
+        'cached_tokens': grouped['cached_tokens'].sum(min_count=1)
+    })
+    return summary[columns].reset_index()
@@ -1,14 +1,22 @@
 import streamlit as st
 import firebase_admin
-from firebase_admin import credentials, auth, firestore
-from openai import OpenAI
+from firebase_admin import credentials, firestore
 from datetime import datetime
+import os
 import pytz
-import requests
 
 # Import configurations
 from stageprompts import INITIAL_ASSISTANT_MESSAGE
-from reviewinstructions import MODULE_LEARNING_OBJECTIVES, MODULE_SYLLABUS, SYSTEM_INSTRUCTIONS, REVIEW_INSTRUCTIONS, DISCLAIMER, SCORING_CRITERIA
+from reviewinstructions import MODULE_LEARNING_OBJECTIVES, MODULE_SYLLABUS, SYSTEM_INSTRUCTIONS, REVIEW_INSTRUCTIONS, DISCLAIMER, SCORING_CRITERIA, INCREMENTAL_REVIEW_INSTRUCTIONS
+from rollups import is_review_request
+from persistence import MessageWriter, new_job
+from authsession import RefreshRejected, sign_in, refresh
+from tracing import span, usage_attrs
+from llmgateway import LLMGateway
+from compression import compact, message_text
+from drafts import MIN_ESSAY_WORDS, find_revision, incremental_review_prompt, new_draft, paragraphs, parse_scores, word_count
+import repository
+import liveviews
 
 # Initialize Firebase
 if not firebase_admin._apps:
@@ -26,6 +34,33 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+@st.cache_resource
+def get_llm_gateway():
+    """Process-wide rate-limited OpenAI client; tune quotas under [llm] in secrets"""
+    return LLMGateway(st.secrets["default"]["OPENAI_API_KEY"], **dict(st.secrets.get("llm", {})))
+
+def generate_title(context):
+    """Summarise recent messages into a 2-3 word conversation title"""
+    with span('llm.title', intent='title', model="gpt-4o-mini") as llm_span:
+        response = get_llm_gateway().complete(
+            lane='title',
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": "Create a 2-3 word title for this conversation."},
+                {"role": "user", "content": context}
+            ],
+            temperature=0.3,
+            max_tokens=10
+        )
+        llm_span.update(usage_attrs(response))
+    return response.choices[0].message.content.strip()
+
+@st.cache_resource
+def get_message_writer():
+    """Process-wide write-behind queue for chat messages"""
+    return MessageWriter(db, title_fn=generate_title,
+                         journal_path=os.environ.get('EWA_WRITE_JOURNAL'))
+
 class EWA:
     def __init__(self):        
         self.tz = pytz.timezone("Europe/London")
@@ -40,22 +75,14 @@ class EWA:
         return dt.strftime("[%Y-%m-%d %H:%M:%S]")           
 
     def get_conversations(self, user_id):
-        """Retrieve conversation history from Firestore"""
-        # Get total conversation count
-        count = len(list(db.collection('conversations')
-                        .where('user_id', '==', user_id)
-                        .stream()))
-    
-        # Calculate start position based on current page
+        """Retrieve one page of conversation titles and whether more follow"""
         page = st.session_state.get('page', 0)
-        start = page * 10
-    
-        return db.collection('conversations')\
-                 .where('user_id', '==', user_id)\
-                 .order_by('updated_at', direction=firestore.Query.DESCENDING)\
-                 .offset(start)\
-                 .limit(10)\
-                 .stream(), count > (start + 10)
+        if liveviews.ENABLED:
+            # Listener-maintained view; falls back to a query until it is ready
+            view = liveviews.session_view(db, user_id)
+            if view is not None:
+                return view.page(page, self.conversations_per_page)
+        return repository.conversation_page(db, user_id, page, self.conversations_per_page)
 
     def render_sidebar(self):
         """Render sidebar with conversation history"""
@@ -64,8 +91,11 @@ class EWA:
         
             if st.button("New Session"):
                 user = st.session_state.user
+                view = st.session_state.get('conversation_view')
                 st.session_state.clear()
                 st.session_state.user = user
+                if view is not None:
+                    st.session_state.conversation_view = view
                 st.session_state.logged_in = True
                 st.session_state.messages = [
                     {**INITIAL_ASSISTANT_MESSAGE, "timestamp": self.format_time()}
@@ -84,20 +114,19 @@ class EWA:
                 st.session_state.page = 0
             
             # Get conversations and has_more flag
-            convs, has_more = self.get_conversations(st.session_state.user.uid)
+            with span('firestore.list_conversations'):
+                convs, has_more = self.get_conversations(st.session_state.user.uid)
         
             # Display conversations
             for conv in convs:
                 conv_data = conv.to_dict()
                 if st.button(f"{conv_data.get('title', 'Untitled')}", key=conv.id):
-                    messages = db.collection('conversations').document(conv.id)\
-                               .collection('messages').order_by('timestamp').stream()
-                    st.session_state.messages = []
-                    for msg in messages:
-                        msg_dict = msg.to_dict()
-                        if 'timestamp' in msg_dict:
-                            msg_dict['timestamp'] = self.format_time(msg_dict['timestamp'])
-                        st.session_state.messages.append(msg_dict)
+                    with span('firestore.load_conversation'):
+                        st.session_state.messages = []
+                        for msg_dict in repository.get_messages(db, conv.id):
+                            if 'timestamp' in msg_dict:
+                                msg_dict['timestamp'] = self.format_time(msg_dict['timestamp'])
+                            st.session_state.messages.append(msg_dict)
                     st.session_state.current_conversation_id = conv.id
                     st.rerun()
             
@@ -133,14 +162,32 @@ class EWA:
        ]
         
         # Check for review/scoring related keywords
-        review_keywords = ["grade", "score", "review", "assess", "evaluate", "feedback", "rubric"]
-        is_review = any(keyword in prompt.lower() for keyword in review_keywords)
+        is_review = is_review_request(prompt)
+        intent = 'review' if is_review else 'chat'
+
+        # A pasted essay may revise a draft already reviewed in this conversation
+        is_essay = is_review and word_count(prompt) >= MIN_ESSAY_WORDS
+        previous_draft = revision = None
+        store_draft = is_essay
+        if is_essay:
+            # Drafts only shorten the review; on any error review the essay in full
+            try:
+                previous_draft = self.get_latest_draft()
+            except Exception:
+                # Without the latest version a new draft could overwrite it
+                store_draft = False
+            try:
+                revision = find_revision(previous_draft, prompt)
+            except Exception:
+                revision = None
     
         if is_review:            
             messages.append({
                 "role": "system",
                 "content": REVIEW_INSTRUCTIONS            
             })            
+            if revision is not None:
+                messages.append({"role": "system", "content": INCREMENTAL_REVIEW_INSTRUCTIONS})
             max_tokens = 5000
             context_window = 10  # Larger context window for review tasks         
         else:            
@@ -148,8 +195,8 @@ class EWA:
             context_window = 6   # Smaller context window for regular chat
 
 
-        # Add conversation history
-        if 'messages' in st.session_state:
+        # Add conversation history (a revision review sends only the changes instead)
+        if 'messages' in st.session_state and revision is None:
             # Keep only the most recent messages within the context window
             recent_messages = st.session_state.messages[-context_window:]
 
@@ -158,97 +205,107 @@ class EWA:
                 if recent_messages[0].get('role') != 'assistant':
                     recent_messages = [st.session_state.messages[0]] + recent_messages[-context_window+1:]
 
-            messages.extend(recent_messages)
+            # Long bodies are only inflated here, when sent as context
+            messages.extend({"role": msg["role"], "content": message_text(msg)} for msg in recent_messages)
 
         # Add current prompt
-        messages.append({"role": "user", "content": prompt})
+        if revision is None:
+            messages.append({"role": "user", "content": prompt})
+        else:
+            messages.append({"role": "user",
+                             "content": incremental_review_prompt(previous_draft, revision, len(paragraphs(prompt)))})
 
         try:
             # Get AI response
-            response = OpenAI(api_key=st.secrets["default"]["OPENAI_API_KEY"]).chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                temperature=0,
-                max_tokens=max_tokens
-            )
+            with span('llm.completion', intent=intent, model="gpt-4o-mini",
+                      incremental=revision is not None) as llm_span:
+                # Short chat turns are hedged; long reviews are not worth duplicating
+                response = get_llm_gateway().complete(
+                    lane=intent,
+                    session_id=st.session_state.user.uid,
+                    hedge=not is_review,
+                    model="gpt-4o-mini",
+                    messages=messages,
+                    temperature=0,
+                    max_tokens=max_tokens
+                )
+                llm_span.update(usage_attrs(response))
 
+            response_time = datetime.now(self.tz)
             assistant_content = response.choices[0].message.content
             
             # Add disclaimer for review responses
             if is_review and ("Estimated Grade" in assistant_content or "Total Score:" in assistant_content):
                 assistant_content = f"{assistant_content}\n\n{DISCLAIMER}"
                 
-            st.chat_message("assistant").write(f"{time_str} {assistant_content}")
+            with span('render.response', intent=intent):
+                st.chat_message("assistant").write(f"{time_str} {assistant_content}")
 
             # Update session state
             if 'messages' not in st.session_state:
                 st.session_state.messages = []
 
-            user_message = {"role": "user", "content": prompt, "timestamp": time_str}
-            assistant_msg = {"role": "assistant", "content": assistant_content, "timestamp": time_str}
+            # Pasted essays and reviews are kept compressed past a size threshold
+            user_message = compact({"role": "user", "content": prompt, "timestamp": time_str})
+            assistant_msg = compact({"role": "assistant", "content": assistant_content, "timestamp": time_str})
             
             st.session_state.messages.extend([user_message, assistant_msg])
 
+            # Store the essay as a new draft version with its scores
+            documents = []
+            if store_draft:
+                scores = parse_scores(assistant_content)
+                if not scores and revision is not None:
+                    scores = previous_draft['scores']
+                version = previous_draft['version'] + 1 if previous_draft else 1
+                draft = new_draft(prompt, version, scores)
+                documents.append(('drafts', str(version), draft))
+
             # Save to database
-            conversation_id = st.session_state.get('current_conversation_id')
-            conversation_id = self.save_message(conversation_id, 
-                                             {**user_message, "timestamp": current_time})
-            self.save_message(conversation_id, 
-                            {**assistant_msg, "timestamp": current_time})
+            with span('save.turn', intent=intent):
+                conversation_id = self.save_message(st.session_state.get('current_conversation_id'),
+                                                    {**user_message, "timestamp": current_time},
+                                                    {**assistant_msg, "timestamp": response_time},
+                                                    documents=documents)
+            if documents:
+                st.session_state.setdefault('drafts', {})[conversation_id] = draft
 
         except Exception as e:
             st.error(f"Error processing message: {str(e)}")
 
-    def save_message(self, conversation_id, message):
-        """Save message and update title with summary"""
-        current_time = datetime.now(self.tz)
+    def get_latest_draft(self):
+        """Latest essay draft in the current conversation, cached in the session"""
+        conversation_id = st.session_state.get('current_conversation_id')
+        if not conversation_id:
+            return None
+        drafts = st.session_state.setdefault('drafts', {})
+        if conversation_id not in drafts:
+            with span('firestore.latest_draft'):
+                drafts[conversation_id] = repository.latest_draft(db, conversation_id)
+        return drafts[conversation_id]
+
+    def save_message(self, conversation_id, *messages, documents=None):
+        """Queue messages for persistence and return the conversation id.
 
+        The write-behind worker commits them, updates rollups and refreshes
+        the title, so the chat turn doesn't wait on Firestore.
+        """
         try:
-            # For new conversation
-            if not conversation_id:
-                new_conv_ref = db.collection('conversations').document()
-                conversation_id = new_conv_ref.id
-                new_conv_ref.set({
-                    'user_id': st.session_state.user.uid,
-                    'created_at': firestore.SERVER_TIMESTAMP,
-                    'updated_at': firestore.SERVER_TIMESTAMP,
-                    'title': f"{current_time.strftime('%b %d, %Y')} • New Chat [1📝]",
-                    'status': 'active'
-                })
+            # For new conversation the id is allocated locally
+            new_conversation = not conversation_id
+            if new_conversation:
+                conversation_id = repository.new_conversation_id(db)
                 st.session_state.current_conversation_id = conversation_id
-        
-            # Save message
-            conv_ref = db.collection('conversations').document(conversation_id)
-            conv_ref.collection('messages').add({
-                **message,
-                "timestamp": firestore.SERVER_TIMESTAMP
-            })
-
-            # Get messages for count and context
-            messages = list(conv_ref.collection('messages').get())
-            count = len(messages)
-        
-            # Get last 5 messages for context
-            recent_messages = [msg.to_dict()['content'] for msg in messages[-5:]]
-            context = " ".join(recent_messages)
-        
-            # Get summary from GPT
-            summary = OpenAI(api_key=st.secrets["default"]["OPENAI_API_KEY"]).chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Create a 2-3 word title for this conversation."},
-                    {"role": "user", "content": context}
-                ],
-                temperature=0.3,
-                max_tokens=10
-            ).choices[0].message.content.strip()
-        
-            # Update conversation with summary title and count
-            conv_ref.set({
-                'updated_at': firestore.SERVER_TIMESTAMP,
-                'title': f"{current_time.strftime('%b %d, %Y')} • {summary} [{count}📝]"
-            }, merge=True)
-        
+
+            # Last 5 messages (previews of long ones) give the title summary its context
+            recent_messages = [msg['content'] for msg in st.session_state.get('messages', [])[-5:]]
+            job = new_job(db, conversation_id, st.session_state.user.uid, messages,
+                          new_conversation=new_conversation,
+                          previous=st.session_state.get('last_message_at'),
+                          context=" ".join(recent_messages),
+                          documents=documents)
+            get_message_writer().submit(job)
+            st.session_state.last_message_at = messages[-1]['timestamp']
             return conversation_id
             
         except Exception as e:
@@ -258,23 +315,8 @@ class EWA:
     def login(self, email, password):
         """Authenticate user with Firebase Auth REST API"""
         try:
-            # Firebase Auth REST API endpoint
-            auth_url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={st.secrets['default']['apiKey']}"
-        
-            # Request body
-            auth_data = {
-                "email": email,
-                "password": password,
-                "returnSecureToken": True
-            }
-        
-            # Make authentication request
-            response = requests.post(auth_url, json=auth_data)
-            if response.status_code != 200:
-                raise Exception("Authentication failed")
-            
-            # Get user details
-            user = auth.get_user_by_email(email)
+            # User details come straight from the sign-in response
+            user = sign_in(st.secrets['default']['apiKey'], email, password)
             st.session_state.user = user
             st.session_state.logged_in = True 
             st.session_state.messages = [{
@@ -287,6 +329,22 @@ class EWA:
         except Exception as e:
             st.error("Login failed")
             return False
+
+    def refresh_session(self):
+        """Keep the ID token fresh so long sessions don't need to log in again"""
+        user = st.session_state.user
+        if not user.needs_refresh():
+            return True
+        try:
+            refresh(st.secrets['default']['apiKey'], user)
+            return True
+        except RefreshRejected:
+            st.session_state.logged_in = False
+            st.error("Session expired, please log in again")
+            return False
+        except Exception:
+            # Transient failure (network, 5xx): keep the session and retry on a later rerun
+            return True
         
 def main():
     app = EWA()
@@ -302,16 +360,20 @@ def main():
                     st.rerun()
         return
 
+    if not app.refresh_session():
+        return
+
     # Main chat interface
     st.title("DUTE Essay Writing Assistant")
     app.render_sidebar()
 
     # Display message history
     if 'messages' in st.session_state:
-        for msg in st.session_state.messages:
-            st.chat_message(msg["role"]).write(
-                f"{msg.get('timestamp', '')} {msg['content']}"
-            )
+        with span('render.history', messages=len(st.session_state.messages)):
+            for msg in st.session_state.messages:
+                st.chat_message(msg["role"]).write(
+                    f"{msg.get('timestamp', '')} {message_text(msg)}"
+                )
 
     # Chat input
     if prompt := st.chat_input("Type your message here..."):
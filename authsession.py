@@ -0,0 +1,126 @@
+import base64
+import json
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import streamlit as st
+from firebase_admin import auth
+
+SIGN_IN_URL = "https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword"
+REFRESH_URL = "https://securetoken.googleapis.com/v1/token"
+REFRESH_MARGIN = 300  # Refresh ID tokens this many seconds before they expire
+REFRESH_RETRY = 30    # Seconds before retrying a refresh that failed transiently
+# securetoken errors meaning the refresh token itself is no longer usable
+REJECTED_REFRESH_ERRORS = {'INVALID_REFRESH_TOKEN', 'TOKEN_EXPIRED', 'USER_DISABLED', 'USER_NOT_FOUND'}
+
+
+class RefreshRejected(Exception):
+    """The refresh token was rejected; the user has to sign in again"""
+
+
+@st.cache_resource
+def get_http_session():
+    """Pooled HTTP session shared by every app session in this process"""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+    return session
+
+
+def decode_token_claims(id_token):
+    """Read the payload of a Firebase ID token without verifying it.
+
+    Only used for tokens we just received from Google over TLS.
+    """
+    payload = id_token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload))
+
+
+class SessionUser:
+    """Signed-in user built from the sign-in response.
+
+    Exposes `uid` and `email` like a UserRecord; the full record is fetched
+    from the Admin SDK only when `record` is first used.
+    """
+
+    def __init__(self, uid, email, id_token, refresh_token, expires_in):
+        self.uid = uid
+        self.email = email
+        self._record = None
+        self.retry_refresh_at = 0.0
+        self._set_tokens(id_token, refresh_token, expires_in)
+
+    def _set_tokens(self, id_token, refresh_token, expires_in):
+        self.id_token = id_token
+        self.refresh_token = refresh_token
+        self.expires_at = time.time() + int(expires_in)
+        self.custom_claims = {
+            key: value for key, value in decode_token_claims(id_token).items()
+            if key not in ('iss', 'aud', 'auth_time', 'user_id', 'sub', 'iat', 'exp',
+                           'email', 'email_verified', 'firebase')
+        }
+
+    @property
+    def record(self):
+        """Full Admin SDK UserRecord, fetched lazily"""
+        if self._record is None:
+            self._record = auth.get_user(self.uid)
+        return self._record
+
+    def needs_refresh(self):
+        """Whether the ID token is expired or about to expire (and a retry is due)"""
+        now = time.time()
+        return now > self.expires_at - REFRESH_MARGIN and now >= self.retry_refresh_at
+
+
+def sign_in(api_key, email, password):
+    """Sign in with email and password via the Firebase Auth REST API"""
+    response = get_http_session().post(
+        SIGN_IN_URL,
+        params={"key": api_key},
+        json={"email": email, "password": password, "returnSecureToken": True},
+        timeout=10
+    )
+    if response.status_code != 200:
+        raise Exception("Authentication failed")
+
+    data = response.json()
+    return SessionUser(data['localId'], data['email'], data['idToken'],
+                       data['refreshToken'], data['expiresIn'])
+
+
+def refresh(api_key, user):
+    """Exchange the user's refresh token for a new ID token in place.
+
+    Raises `RefreshRejected` when the token is no longer valid; any other
+    failure (network, 5xx) defers the next attempt by `REFRESH_RETRY` seconds
+    and re-raises.
+    """
+    try:
+        response = get_http_session().post(
+            REFRESH_URL,
+            params={"key": api_key},
+            data={"grant_type": "refresh_token", "refresh_token": user.refresh_token},
+            timeout=10
+        )
+    except requests.RequestException:
+        user.retry_refresh_at = time.time() + REFRESH_RETRY
+        raise
+    if response.status_code == 400 and _error_code(response) in REJECTED_REFRESH_ERRORS:
+        raise RefreshRejected(_error_code(response))
+    if response.status_code != 200:
+        user.retry_refresh_at = time.time() + REFRESH_RETRY
+        raise Exception(f"Token refresh failed ({response.status_code})")
+
+    data = response.json()
+    user._set_tokens(data['id_token'], data['refresh_token'], data['expires_in'])
+    return user
+
+
+def _error_code(response):
+    """Error code from a Google identity REST error, e.g. TOKEN_EXPIRED"""
+    try:
+        message = response.json()['error']['message']
+    except (ValueError, KeyError, TypeError):
+        return None
+    return message.split(':')[0].strip()
@@ -0,0 +1,726 @@
+"""In-process stand-ins for Firestore, Firebase Auth and Streamlit.
+
+`install()` registers fake `firebase_admin` and `streamlit` modules in
+`sys.modules` so `app` and `pages/admin.py` can be imported and driven
+from plain threads with no network. Every Firestore RPC is counted in
+`FakeFirestore.stats` and can be given an artificial latency.
+"""
+import copy
+import itertools
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+# Firestore sentinels and transforms
+
+
+class Sentinel:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"Sentinel({self.name})"
+
+
+SERVER_TIMESTAMP = Sentinel('SERVER_TIMESTAMP')
+DELETE_FIELD = Sentinel('DELETE_FIELD')
+
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+class ArrayUnion:
+    def __init__(self, values):
+        self.values = list(values)
+
+
+class Query:
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _apply_value(current, value):
+    if value is SERVER_TIMESTAMP:
+        return _now()
+    if isinstance(value, Increment):
+        return (current or 0) + value.value
+    if isinstance(value, ArrayUnion):
+        existing = list(current or [])
+        return existing + [item for item in value.values if item not in existing]
+    if isinstance(value, dict):
+        return {key: _apply_value(None, item) for key, item in value.items()}
+    return copy.deepcopy(value)
+
+
+def _apply_update(existing, data, merge):
+    result = dict(existing or {}) if merge else {}
+    for key, value in data.items():
+        if value is DELETE_FIELD:
+            result.pop(key, None)
+        else:
+            result[key] = _apply_value(result.get(key), value)
+    return result
+
+
+def _field(data, path):
+    for part in path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return _MISSING
+        data = data[part]
+    return data
+
+
+_MISSING = object()
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'in': lambda a, b: a in b,
+    'not-in': lambda a, b: a not in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+    'array_contains_any': lambda a, b: isinstance(a, list) and any(item in a for item in b),
+}
+
+
+class FieldFilter:
+    def __init__(self, field_path, op_string, value):
+        self.field_path = field_path
+        self.op_string = op_string
+        self.value = value
+
+
+# Snapshots and references
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        value = _field(self._data or {}, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+
+class AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class DocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name):
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._rpc(reads=1)
+        if transaction is not None:
+            transaction._track(self.path)
+        return DocumentSnapshot(self, self._client._read(self.path))
+
+    def set(self, data, merge=False):
+        self._client._rpc(writes=1)
+        self._client._write(self.path, data, merge=merge)
+
+    def update(self, data):
+        self._client._rpc(writes=1)
+        if self._client._read(self.path) is None:
+            raise KeyError(f"No document to update: {self.path}")
+        self._client._write(self.path, data, merge=True)
+
+    def delete(self):
+        self._client._rpc(writes=1)
+        self._client._delete(self.path)
+
+    def on_snapshot(self, callback):
+        return self._client._listen(self, callback)
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class BaseQuery:
+    def __init__(self, client, path, all_descendants=False):
+        self._client = client
+        self._path = path
+        self._all_descendants = all_descendants
+        self._filters = []
+        self._orders = []
+        self._limit = None
+        self._offset = 0
+        self._start_after = None
+        self._projection = None
+
+    def _copy(self, **changes):
+        query = copy.copy(self)
+        query._filters = list(self._filters)
+        query._orders = list(self._orders)
+        for key, value in changes.items():
+            setattr(query, key, value)
+        return query
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        query = self._copy()
+        query._filters.append((field_path, op_string, value))
+        return query
+
+    def order_by(self, field_path, direction=Query.ASCENDING):
+        query = self._copy()
+        query._orders.append((field_path, direction))
+        return query
+
+    def limit(self, count):
+        return self._copy(_limit=count)
+
+    def offset(self, count):
+        return self._copy(_offset=count)
+
+    def start_after(self, document):
+        return self._copy(_start_after=document)
+
+    def select(self, field_paths):
+        return self._copy(_projection=list(field_paths))
+
+    def count(self, alias=None):
+        return AggregationQuery(self, alias or 'count')
+
+    def _matches(self):
+        docs = self._client._documents(self._path, self._all_descendants)
+        for field_path, op_string, value in self._filters:
+            compare = _OPERATORS[op_string]
+            docs = [(path, data) for path, data in docs
+                    if _field(data, field_path) is not _MISSING
+                    and _safe(compare, _field(data, field_path), value)]
+        for field_path, _ in self._orders:
+            docs = [(path, data) for path, data in docs if _field(data, field_path) is not _MISSING]
+        for field_path, direction in reversed(self._orders):
+            docs.sort(key=lambda item: _field(item[1], field_path),
+                      reverse=direction == Query.DESCENDING)
+        if self._start_after is not None:
+            paths = [path for path, _ in docs]
+            start_path = self._start_after.reference.path
+            if start_path in paths:
+                docs = docs[paths.index(start_path) + 1:]
+        docs = docs[self._offset:]
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return docs
+
+    def _snapshot(self, path, data):
+        # Like Firestore: an empty projection returns every field, `__name__` none
+        if self._projection:
+            data = {field: data[field] for field in self._projection if field in data}
+        return DocumentSnapshot(DocumentReference(self._client, path), copy.deepcopy(data))
+
+    def stream(self, transaction=None):
+        docs = self._matches()
+        self._client._rpc(reads=max(1, len(docs)))
+        return iter([self._snapshot(path, data) for path, data in docs])
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        return self._client._listen(self, callback)
+
+
+def _safe(compare, a, b):
+    try:
+        return compare(a, b)
+    except TypeError:
+        return False
+
+
+class AggregationQuery:
+    def __init__(self, query, alias):
+        self._query = query
+        self._alias = alias
+
+    def get(self, transaction=None):
+        total = len(self._query._matches())
+        self._query._client._rpc(reads=1 + total // 1000)
+        return [[AggregationResult(self._alias, total)]]
+
+
+class CollectionReference(BaseQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        if '/' not in self._path:
+            return None
+        return DocumentReference(self._client, self._path.rsplit('/', 1)[0])
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data, document_id=None):
+        ref = self.document(document_id)
+        ref.set(data)
+        return _now(), ref
+
+    def list_documents(self):
+        return [DocumentReference(self._client, path)
+                for path, _ in self._client._documents(self._path, False)]
+
+
+class WriteBatch:
+    MAX_WRITES = 500
+
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, reference, data, merge=False):
+        self._ops.append(('set', reference.path, data, merge))
+
+    def update(self, reference, data):
+        self._ops.append(('update', reference.path, data, True))
+
+    def delete(self, reference):
+        self._ops.append(('delete', reference.path, None, False))
+
+    def _check(self):
+        """Raise if the batch can't be applied; called with the client lock held"""
+
+    def commit(self):
+        if len(self._ops) > self.MAX_WRITES:
+            raise ValueError(f"Batch too large: {len(self._ops)} writes")
+        self._client._rpc(writes=len(self._ops), batches=1)
+        with self._client._lock:
+            self._check()
+            for op, path, data, merge in self._ops:
+                if op == 'delete':
+                    self._client._delete(path, notify=False)
+                else:
+                    self._client._write(path, data, merge=merge, notify=False)
+        self._ops = []
+        self._client._notify()
+
+
+class Aborted(Exception):
+    """A transaction's reads changed before it committed"""
+
+
+class Transaction(WriteBatch):
+    """Optimistic transaction: commit fails if a document it read has since changed"""
+
+    def __init__(self, client):
+        super().__init__(client)
+        self._reads = {}
+
+    def _track(self, path):
+        with self._client._lock:
+            self._reads.setdefault(path, self._client._versions[path])
+
+    def _reset(self):
+        self._ops = []
+        self._reads = {}
+
+    def _check(self):
+        changed = [path for path, version in self._reads.items() if self._client._versions[path] != version]
+        if changed:
+            self._ops = []
+            raise Aborted(f"Transaction contention on {', '.join(changed)}")
+
+
+def transactional(func, max_attempts=5):
+    """Run `func(transaction, ...)` and commit, retrying on contention"""
+    def wrapper(transaction, *args, **kwargs):
+        for _ in range(max_attempts):
+            transaction._reset()
+            result = func(transaction, *args, **kwargs)
+            try:
+                transaction.commit()
+                return result
+            except Aborted:
+                continue
+        raise Aborted(f"Transaction failed after {max_attempts} attempts")
+    return wrapper
+
+
+class FakeFirestore:
+    """Thread-safe in-memory Firestore client with RPC accounting"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.stats = Counter()
+        self._collections = {}
+        self._versions = Counter()
+        self._lock = threading.RLock()
+        self._listeners = []
+
+    def _rpc(self, reads=0, writes=0, batches=0):
+        with self._lock:
+            self.stats['rpcs'] += 1
+            self.stats['reads'] += reads
+            self.stats['writes'] += writes
+            self.stats['batches'] += batches
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _read(self, path):
+        collection, doc_id = path.rsplit('/', 1)
+        with self._lock:
+            return copy.deepcopy(self._collections.get(collection, {}).get(doc_id))
+
+    def _write(self, path, data, merge=False, notify=True):
+        collection, doc_id = path.rsplit('/', 1)
+        with self._lock:
+            docs = self._collections.setdefault(collection, {})
+            docs[doc_id] = _apply_update(docs.get(doc_id), data, merge)
+            self._versions[path] += 1
+        if notify:
+            self._notify()
+
+    def _delete(self, path, notify=True):
+        collection, doc_id = path.rsplit('/', 1)
+        with self._lock:
+            self._collections.get(collection, {}).pop(doc_id, None)
+            self._versions[path] += 1
+        if notify:
+            self._notify()
+
+    def _documents(self, path, all_descendants):
+        with self._lock:
+            if not all_descendants:
+                return [(f"{path}/{doc_id}", data)
+                        for doc_id, data in self._collections.get(path, {}).items()]
+            return [(f"{collection}/{doc_id}", data)
+                    for collection, docs in self._collections.items()
+                    if collection.rsplit('/', 1)[-1] == path
+                    for doc_id, data in docs.items()]
+
+    def _listen(self, target, callback):
+        watch = Watch(self, target, callback)
+        with self._lock:
+            self._listeners.append(watch)
+        watch.refresh()
+        return watch
+
+    def _notify(self):
+        with self._lock:
+            listeners = list(self._listeners)
+        for watch in listeners:
+            watch.refresh()
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def collection_group(self, name):
+        return BaseQuery(self, name, all_descendants=True)
+
+    def document(self, path):
+        return DocumentReference(self, path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self):
+        return Transaction(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        if not references:
+            return
+        self._rpc(reads=len(references))
+        for ref in references:
+            if transaction is not None:
+                transaction._track(ref.path)
+            yield DocumentSnapshot(ref, self._read(ref.path))
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats.clear()
+
+
+class DocumentChange:
+    def __init__(self, type_name, document):
+        self.type = types.SimpleNamespace(name=type_name)
+        self.document = document
+
+
+class Watch:
+    """Minimal snapshot listener delivering added/modified/removed changes"""
+
+    def __init__(self, client, target, callback):
+        self._client = client
+        self._target = target
+        self._callback = callback
+        self._seen = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        if self._closed:
+            return
+        if isinstance(self._target, DocumentReference):
+            data = self._client._read(self._target.path)
+            current = {self._target.path: data} if data is not None else {}
+        else:
+            current = dict(self._target._matches())
+        seen = self._seen or {}
+        changes = []
+        for path, data in current.items():
+            if path not in seen:
+                changes.append(('ADDED', path, data))
+            elif seen[path] != data:
+                changes.append(('MODIFIED', path, data))
+        changes += [('REMOVED', path, data) for path, data in seen.items() if path not in current]
+        if not changes and self._seen is not None:
+            return
+        self._seen = copy.deepcopy(current)
+        self._client._rpc(reads=max(1, len(changes)))
+        snapshots = [DocumentSnapshot(DocumentReference(self._client, path), copy.deepcopy(data))
+                     for path, data in current.items()]
+        change_objs = [DocumentChange(kind, DocumentSnapshot(DocumentReference(self._client, path),
+                                                            copy.deepcopy(data)))
+                       for kind, path, data in changes]
+        self._callback(snapshots, change_objs, _now())
+
+    def unsubscribe(self):
+        self._closed = True
+        with self._client._lock:
+            if self in self._client._listeners:
+                self._client._listeners.remove(self)
+
+
+# Firebase Auth
+
+
+class FakeAuth:
+    """Minimal firebase_admin.auth replacement backed by a user dict"""
+
+    def __init__(self):
+        self.users = {}
+
+    def add_user(self, uid, email, custom_claims=None):
+        self.users[uid] = types.SimpleNamespace(uid=uid, email=email,
+                                                custom_claims=custom_claims or {})
+        return self.users[uid]
+
+    def get_user(self, uid):
+        return self.users[uid]
+
+    def get_user_by_email(self, email):
+        return next(user for user in self.users.values() if user.email == email)
+
+    def list_users(self):
+        return types.SimpleNamespace(iterate_all=lambda: iter(list(self.users.values())))
+
+    def set_custom_user_claims(self, uid, claims):
+        self.users[uid].custom_claims = dict(claims or {})
+
+
+# Streamlit
+
+
+class SessionState(dict):
+    """Attribute-accessible dict standing in for st.session_state"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        del self[name]
+
+
+class _Element:
+    """No-op widget/container: callable, a context manager and attribute-chainable"""
+
+    def __call__(self, *args, **kwargs):
+        return _Element()
+
+    def __getattr__(self, name):
+        return _Element()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class RerunException(Exception):
+    pass
+
+
+class FakeStreamlit(types.ModuleType):
+    """Headless streamlit module with per-thread session state"""
+
+    def __init__(self, secrets=None):
+        super().__init__('streamlit')
+        self.secrets = secrets or {}
+        self._local = threading.local()
+        self.sidebar = _Element()
+        self.column_config = _Element()
+        self.errors = []
+
+    @property
+    def session_state(self):
+        if not hasattr(self._local, 'state'):
+            self._local.state = SessionState()
+        return self._local.state
+
+    def reset_session(self):
+        self._local.state = SessionState()
+
+    def __getattr__(self, name):
+        return _Element()
+
+    def error(self, message, *args, **kwargs):
+        self.errors.append(str(message))
+
+    def button(self, *args, **kwargs):
+        return False
+
+    def checkbox(self, label='', value=False, *args, **kwargs):
+        return value
+
+    def selectbox(self, label, options=(), *args, **kwargs):
+        options = list(options)
+        return options[0] if options else None
+
+    def chat_input(self, *args, **kwargs):
+        return None
+
+    def columns(self, spec, *args, **kwargs):
+        count = spec if isinstance(spec, int) else len(spec)
+        return [_Element() for _ in range(count)]
+
+    def rerun(self):
+        raise RerunException()
+
+    def cache_data(self, func=None, **kwargs):
+        return _memoize(func, kwargs.get('ttl'))
+
+    def cache_resource(self, func=None, **kwargs):
+        return _memoize(func, None)
+
+
+def _memoize(func, ttl):
+    """Process-wide memoization matching st.cache_* argument hashing rules"""
+    if func is None:
+        return lambda inner: _memoize(inner, ttl)
+
+    cache = {}
+    lock = threading.Lock()
+    key_locks = {}
+
+    def wrapper(*args, **kwargs):
+        names = func.__code__.co_varnames[:func.__code__.co_argcount]
+        key = tuple((name, repr(value)) for name, value in itertools.chain(zip(names, args), sorted(kwargs.items()))
+                    if not name.startswith('_'))
+        with lock:
+            key_lock = key_locks.setdefault(key, threading.Lock())
+        # Like Streamlit, compute each key once even under concurrent callers
+        with key_lock:
+            hit = cache.get(key)
+            if hit and (ttl is None or time.monotonic() - hit[1] < ttl):
+                return hit[0]
+            value = func(*args, **kwargs)
+            cache[key] = (value, time.monotonic())
+            return value
+
+    wrapper.clear = cache.clear
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+# Installation
+
+
+def install(db=None, secrets=None, auth=None, firebase=True):
+    """Register fake streamlit (and firebase_admin) modules; returns (db, auth, st).
+
+    With `firebase=False` only Streamlit is faked and `db` should be a real
+    client, e.g. one connected to the Firestore emulator.
+    """
+    db = db or FakeFirestore()
+    auth = auth or FakeAuth()
+    st = FakeStreamlit(secrets or {
+        'FIREBASE': {},
+        'default': {'OPENAI_API_KEY': 'sk-offline', 'apiKey': 'offline'}
+    })
+    sys.modules['streamlit'] = st
+    if not firebase:
+        return db, auth, st
+
+    firestore_mod = types.ModuleType('firebase_admin.firestore')
+    firestore_mod.client = lambda app=None, database_id=None: db
+    firestore_mod.SERVER_TIMESTAMP = SERVER_TIMESTAMP
+    firestore_mod.DELETE_FIELD = DELETE_FIELD
+    firestore_mod.Increment = Increment
+    firestore_mod.ArrayUnion = ArrayUnion
+    firestore_mod.Query = Query
+    firestore_mod.FieldFilter = FieldFilter
+    firestore_mod.transactional = transactional
+
+    auth_mod = types.ModuleType('firebase_admin.auth')
+    for name in ('get_user', 'get_user_by_email', 'list_users', 'set_custom_user_claims'):
+        setattr(auth_mod, name, getattr(auth, name))
+
+    credentials_mod = types.ModuleType('firebase_admin.credentials')
+    credentials_mod.Certificate = lambda *args, **kwargs: object()
+
+    firebase_mod = types.ModuleType('firebase_admin')
+    firebase_mod._apps = {'[DEFAULT]': object()}
+    firebase_mod.initialize_app = lambda *args, **kwargs: None
+    firebase_mod.firestore = firestore_mod
+    firebase_mod.auth = auth_mod
+    firebase_mod.credentials = credentials_mod
+
+    sys.modules.update({
+        'firebase_admin': firebase_mod,
+        'firebase_admin.firestore': firestore_mod,
+        'firebase_admin.auth': auth_mod,
+        'firebase_admin.credentials': credentials_mod,
+    })
+    return db, auth, st
@@ -0,0 +1,83 @@
+"""Check firestore.indexes.json against the queries in repository.py.
+
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.indexcheck
+
+First checks statically that every shape in `repository.QUERY_SHAPES` is
+served by the manifest and that no composite index is unused, then runs each
+repository query once against the Firestore emulator (started with
+`firebase emulators:start --only firestore`, which loads the manifest from
+firebase.json) so malformed queries fail here rather than in the app. The
+emulator does not reject queries for missing indexes, which is why the
+static check comes first. Exits non-zero on any problem.
+"""
+import argparse
+import sys
+from datetime import datetime, timezone
+
+from benchmarks import fakes
+from benchmarks.loadtest import connect_emulator
+
+PROBE_ID = 'index-check'
+
+
+def probe_queries(repository, db):
+    """Run every repository query once with placeholder values; returns failures"""
+    probes = {
+        'conversation_page': lambda: repository.conversation_page(db, PROBE_ID, page=1),
+        'user_conversation_ids': lambda: repository.user_conversation_ids(db, PROBE_ID),
+        'get_conversations': lambda: repository.get_conversations(db, [PROBE_ID]),
+        'get_messages': lambda: repository.get_messages(db, PROBE_ID),
+        'count_messages': lambda: repository.count_messages(db, PROBE_ID),
+        'messages_since': lambda: repository.messages_since(db, datetime.now(timezone.utc), limit=1),
+        'latest_draft': lambda: repository.latest_draft(db, PROBE_ID),
+        'get_user': lambda: repository.get_user(db, PROBE_ID, fields=['role']),
+        'find_user_by_email': lambda: repository.find_user_by_email(db, f"{PROBE_ID}@example.com", fields=['role']),
+        'list_users': lambda: repository.list_users(db),
+        'count_users': lambda: repository.count_users(db),
+        'count_conversations': lambda: repository.count_conversations(db),
+        'recent_metric_batches': lambda: repository.recent_metric_batches(db, limit=1),
+        'get_user_rollups': lambda: repository.get_user_rollups(db),
+        'get_last_active': lambda: repository.get_last_active(db, [PROBE_ID]),
+        'get_daily_rollups': lambda: repository.get_daily_rollups(db, ['2000-01-01']),
+        'get_rollup_watermark': lambda: repository.get_rollup_watermark(db),
+    }
+    failures = []
+    for name, probe in probes.items():
+        try:
+            probe()
+        except Exception as e:
+            failures.append((name, e))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--firestore', choices=['emulator', 'memory'], default='emulator')
+    parser.add_argument('--project', default='demo-ewa', help="project id for the emulator")
+    parser.add_argument('--manifest', help="index manifest (default: firestore.indexes.json)")
+    args = parser.parse_args(argv)
+
+    db = connect_emulator(args.project) if args.firestore == 'emulator' else None
+    db, _, _ = fakes.install(db=db, firebase=args.firestore == 'memory')
+    import repository
+
+    manifest = repository.load_index_manifest(args.manifest or repository.INDEX_MANIFEST)
+    problems = 0
+    for group, scope, fields in repository.missing_indexes(manifest):
+        problems += 1
+        spec = ", ".join(f"{field} {order}" for field, order in fields)
+        print(f"MISSING  {group} ({scope}): {spec}")
+    for index in repository.unused_indexes(manifest):
+        problems += 1
+        spec = ", ".join(f"{field['fieldPath']} {field.get('order')}" for field in index['fields'])
+        print(f"UNUSED   {index['collectionGroup']} ({index.get('queryScope', 'COLLECTION')}): {spec}")
+    for name, error in probe_queries(repository, db):
+        problems += 1
+        print(f"FAILED   {name}: {error}")
+
+    print(f"{len(repository.QUERY_SHAPES)} query shapes checked, {problems} problem(s)")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""Offline load test for the chat and admin paths.
+
+    python -m benchmarks.loadtest --students 20 --turns 6
+
+Simulates concurrent students (sidebar render + chat turns) and optionally
+admins refreshing the dashboard, against an in-memory Firestore fake (or the
+Firestore emulator with `--firestore emulator`) and a local OpenAI stub.
+Reports p50/p95/p99 latency per operation plus Firestore read/write and LLM
+call counts. Nothing leaves the machine.
+"""
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+from pathlib import Path
+from types import SimpleNamespace
+
+from benchmarks import fakes
+from benchmarks.openai_stub import StubOpenAIServer
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CHAT_PROMPTS = [
+    "How should I structure the introduction of my essay?",
+    "Can you explain what counts as a strong argument in this module?",
+    "What sources would support a point about AI tutoring systems?",
+    "How do I make my conclusion less repetitive?",
+    "Is my thesis statement specific enough?",
+]
+ESSAY_PARAGRAPH = (
+    "Artificial intelligence is reshaping how students receive feedback on their writing. "
+    "Adaptive systems can respond at scale, but they also raise questions about agency, "
+    "assessment validity and the role of the teacher in the learning process. "
+)
+ESSAY_PARAGRAPHS = [f"Section {number}. " + ESSAY_PARAGRAPH * 4 for number in range(1, 7)]
+
+
+def review_prompt(revision):
+    """Essay review request; each revision rewrites one paragraph of the previous one"""
+    paragraphs = list(ESSAY_PARAGRAPHS)
+    for number in range(revision):
+        index = number % len(paragraphs)
+        paragraphs[index] = f"Revision {number + 1}: this section now adds a counterargument. " + paragraphs[index]
+    return "Please review and grade my essay:\n\n" + "\n\n".join(paragraphs)
+
+
+class Recorder:
+    """Thread-safe latency samples per operation"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.failures = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def wrap(self, owner, name, label=None):
+        """Replace `owner.name` with a timed wrapper"""
+        func = getattr(owner, name)
+        label = label or f"{owner.__name__}.{name}"
+        recorder = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                with recorder._lock:
+                    recorder.failures[label] += 1
+                raise
+            finally:
+                recorder.record(label, time.perf_counter() - start)
+
+        setattr(owner, name, timed)
+
+    def summary(self):
+        report = {}
+        for name, values in sorted(self.samples.items()):
+            values = sorted(values)
+            report[name] = {
+                'count': len(values),
+                'failures': self.failures.get(name, 0),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'max_ms': values[-1] * 1000,
+            }
+        return report
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.4999)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def connect_emulator(project):
+    """Real Firestore client bound to FIRESTORE_EMULATOR_HOST"""
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        raise SystemExit("Set FIRESTORE_EMULATOR_HOST to use --firestore emulator")
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    from google.auth.credentials import AnonymousCredentials
+
+    class EmulatorCredential(credentials.Base):
+        def get_credential(self):
+            return AnonymousCredentials()
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(EmulatorCredential(), {'projectId': project})
+    return firestore.client()
+
+
+def load_modules():
+    """Import the app and admin page against the installed fakes"""
+    sys.path.insert(0, str(ROOT))
+    import app
+    spec = importlib.util.spec_from_file_location('admin_page', ROOT / 'pages' / 'admin.py')
+    admin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(admin)
+    return app, admin
+
+
+def student_user(index):
+    uid = f"student-{index:03d}"
+    return SimpleNamespace(uid=uid, email=f"{uid}@example.ac.uk", custom_claims={},
+                           needs_refresh=lambda: False)
+
+
+def run_student(app, st, index, args, barrier, errors):
+    """One student: render the sidebar and send chat/review turns"""
+    rng = random.Random(args.seed + index)
+    st.reset_session()
+    ewa = app.EWA()
+    st.session_state.user = student_user(index)
+    st.session_state.logged_in = True
+    st.session_state.messages = [{**app.INITIAL_ASSISTANT_MESSAGE, "timestamp": ewa.format_time()}]
+    barrier.wait()
+
+    revisions = 0
+    for turn in range(args.turns):
+        try:
+            ewa.render_sidebar()
+            is_review = args.review_every and (turn + 1) % args.review_every == 0
+            if is_review:
+                ewa.handle_chat(review_prompt(revisions))
+                revisions += 1
+            else:
+                ewa.handle_chat(rng.choice(CHAT_PROMPTS))
+        except Exception:
+            errors.append(traceback.format_exc())
+        if args.think_time:
+            time.sleep(rng.uniform(0, 2 * args.think_time))
+
+
+def run_admin(admin, st, args, barrier, done, errors):
+    """Admin refreshing the dashboard until the students finish"""
+    st.reset_session()
+    st.session_state.user = SimpleNamespace(uid='admin', email='admin@example.ac.uk',
+                                            custom_claims={'admin': True})
+    barrier.wait()
+    while not done.is_set():
+        try:
+            admin.AdminDashboard().render_dashboard()
+        except Exception:
+            errors.append(traceback.format_exc())
+        done.wait(args.admin_interval)
+
+
+def seed_users(db, students):
+    for index in range(students):
+        user = student_user(index)
+        db.collection('users').document(user.uid).set({'email': user.email, 'role': 'user'})
+    db.collection('users').document('admin').set({'email': 'admin@example.ac.uk', 'role': 'admin'})
+
+
+def run(args):
+    db = None if args.firestore == 'memory' else connect_emulator(args.project)
+    db, _, st = fakes.install(db=db or fakes.FakeFirestore(latency=args.firestore_latency / 1000),
+                              firebase=args.firestore == 'memory')
+
+    stub = StubOpenAIServer(latency=args.llm_latency / 1000, tokens_per_second=args.llm_tps,
+                            completion_tokens=args.llm_tokens, error_rate=args.llm_error_rate,
+                            seed=args.seed).start()
+    os.environ['OPENAI_BASE_URL'] = stub.base_url
+    os.environ['NO_PROXY'] = os.environ['no_proxy'] = '127.0.0.1,localhost'
+    if args.live_views:
+        os.environ['EWA_LIVE_VIEWS'] = '1'
+
+    app, admin = load_modules()
+    recorder = Recorder()
+    recorder.wrap(app.EWA, 'handle_chat')
+    recorder.wrap(app.EWA, 'save_message')
+    recorder.wrap(app.EWA, 'get_conversations')
+    recorder.wrap(app.EWA, 'render_sidebar')
+    recorder.wrap(admin.AdminDashboard, 'render_dashboard')
+    recorder.wrap(app.MessageWriter, 'write_now')
+
+    seed_users(db, args.students)
+    if hasattr(db, 'reset_stats'):
+        db.reset_stats()
+
+    errors = []
+    done = threading.Event()
+    barrier = threading.Barrier(args.students + args.admins)
+    students = [threading.Thread(target=run_student, args=(app, st, index, args, barrier, errors))
+                for index in range(args.students)]
+    admins = [threading.Thread(target=run_admin, args=(admin, st, args, barrier, done, errors))
+              for _ in range(args.admins)]
+
+    start = time.perf_counter()
+    for thread in students + admins:
+        thread.start()
+    for thread in students:
+        thread.join()
+    done.set()
+    for thread in admins:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Let the write-behind queue drain so its writes are counted
+    writer = app.get_message_writer()
+    drained = writer.flush(timeout=args.drain_timeout)
+    stub.stop()
+
+    # Finished sessions' leases are released when their state is collected
+    import liveviews
+    gc.collect()
+    live_views = None
+    if args.live_views:
+        active = liveviews.views.active()  # Applies the queued releases first
+        live_views = {**liveviews.views.stats, 'active': active}
+
+    return {
+        'config': vars(args),
+        'elapsed_s': elapsed,
+        'operations': recorder.summary(),
+        'firestore': dict(db.stats) if hasattr(db, 'stats') else None,
+        'llm': dict(stub.stats),
+        'writer': {**writer.stats, 'drained': drained, 'pending': writer.pending()},
+        'gateway': dict(app.get_llm_gateway().stats),
+        'live_views': live_views,
+        'ui_errors': len(st.errors),
+        'exceptions': errors,
+    }
+
+
+def print_report(report):
+    print(f"\n{report['config']['students']} students x {report['config']['turns']} turns, "
+          f"{report['config']['admins']} admin(s) in {report['elapsed_s']:.1f}s\n")
+    print(f"{'operation':<32}{'count':>7}{'fail':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in report['operations'].items():
+        print(f"{name:<32}{stats['count']:>7}{stats['failures']:>6}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    if report['firestore'] is not None:
+        fs = report['firestore']
+        print(f"\nFirestore: {fs.get('reads', 0)} reads, {fs.get('writes', 0)} writes, "
+              f"{fs.get('rpcs', 0)} RPCs, {fs.get('batches', 0)} batch commits")
+    llm = report['llm']
+    print(f"LLM: {llm.get('requests', 0)} requests, {llm.get('completions', 0)} completions, "
+          f"{llm.get('rate_limited', 0)} rate limited, {llm.get('prompt_tokens', 0)} prompt / "
+          f"{llm.get('completion_tokens', 0)} completion tokens")
+    gateway = report['gateway']
+    print(f"Gateway: {gateway.get('retries', 0)} retries, {gateway.get('rate_limited', 0)} Retry-After waits, "
+          f"{gateway.get('hedges', 0)} hedges ({gateway.get('hedge_wins', 0)} won, "
+          f"{gateway.get('hedges_skipped', 0)} skipped), "
+          f"{gateway.get('exhausted', 0)} gave up")
+    writer = report['writer']
+    print(f"Write-behind: {writer['jobs']} turns in {writer['batches']} batches, "
+          f"{writer['retries']} retries, {writer['fallbacks']} sync fallbacks, "
+          f"{writer['pending']} still pending")
+    if report['live_views'] is not None:
+        views = report['live_views']
+        print(f"Live views: {views.get('listeners_started', 0)} listeners started, "
+              f"{views.get('listeners_stopped', 0)} stopped, {views['active']} still active")
+    print(f"UI errors: {report['ui_errors']}, exceptions: {len(report['exceptions'])}")
+    for error in report['exceptions'][:3]:
+        print(error)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=10)
+    parser.add_argument('--turns', type=int, default=4, help="chat turns per student")
+    parser.add_argument('--review-every', type=int, default=3, help="every Nth turn is an essay review (0 = never)")
+    parser.add_argument('--think-time', type=float, default=0.0, help="mean seconds between turns")
+    parser.add_argument('--admins', type=int, default=1)
+    parser.add_argument('--admin-interval', type=float, default=1.0, help="seconds between dashboard renders")
+    parser.add_argument('--firestore', choices=['memory', 'emulator'], default='memory')
+    parser.add_argument('--project', default='demo-ewa', help="project id for the emulator")
+    parser.add_argument('--firestore-latency', type=float, default=5.0, help="ms per in-memory Firestore RPC")
+    parser.add_argument('--llm-latency', type=float, default=200.0, help="ms before the stub starts generating")
+    parser.add_argument('--llm-tps', type=float, default=400.0, help="stub completion tokens per second")
+    parser.add_argument('--llm-tokens', type=int, default=150, help="stub completion length cap")
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help="fraction of stub requests answered with 429")
+    parser.add_argument('--drain-timeout', type=float, default=60.0,
+                        help="seconds to wait for queued writes after the run")
+    parser.add_argument('--live-views', action='store_true',
+                        help="serve sidebar and admin lists from snapshot listeners (EWA_LIVE_VIEWS=1)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the report to this path")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
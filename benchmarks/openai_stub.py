@@ -0,0 +1,126 @@
+"""Local stand-in for the OpenAI chat completions endpoint.
+
+Serves `/v1/chat/completions` on 127.0.0.1 with a configurable base latency
+and token rate, and can inject 429s to exercise rate-limit handling. Point
+the OpenAI client at it with `OPENAI_BASE_URL=<stub.base_url>`.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubOpenAIServer:
+    """Threaded HTTP server answering chat completion requests"""
+
+    def __init__(self, latency=0.3, tokens_per_second=80.0, completion_tokens=200,
+                 error_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, **increments):
+        with self._lock:
+            self.stats.update(increments)
+
+    def _reject(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def completion(self, body):
+        """Build a completion response and the time it should take"""
+        prompt_text = " ".join(str(msg.get('content', '')) for msg in body.get('messages', []))
+        prompt_tokens = max(1, len(prompt_text) // 4)
+        completion_tokens = min(body.get('max_tokens') or self.completion_tokens, self.completion_tokens)
+        delay = self.latency + completion_tokens / self.tokens_per_second
+        content = " ".join(["lorem"] * completion_tokens)
+        if "Review Template" in prompt_text:
+            # Enough of the review template for score parsing downstream
+            content = (f"# Estimated Grade\n**Total Score: [70/100]**\n"
+                       f"1. **Grasp of Field (28/40):** {content}\n"
+                       f"2. **Research & Methodology (28/40):**\n3. **Structure (14/20):**")
+        return delay, {
+            "id": f"chatcmpl-stub-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'stub'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0}
+            }
+        }
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if not self.path.endswith('/chat/completions'):
+                    self._send(404, {"error": {"message": "not found"}})
+                    return
+                if stub._reject():
+                    stub._count(requests=1, rate_limited=1)
+                    self._send(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                               {"retry-after": str(stub.retry_after)})
+                    return
+
+                delay, payload = stub.completion(body)
+                time.sleep(delay)
+                usage = payload['usage']
+                stub._count(requests=1, completions=1,
+                            prompt_tokens=usage['prompt_tokens'],
+                            completion_tokens=usage['completion_tokens'])
+                self._send(200, payload)
+
+        return Handler
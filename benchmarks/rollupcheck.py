@@ -0,0 +1,121 @@
+"""Consistency checks for the engagement rollups against the in-memory Firestore.
+
+    python -m benchmarks.rollupcheck
+
+Runs `rollups.run_incremental` through scenarios that have gone wrong before
+and checks the resulting rollup documents: concurrent runs over the same
+messages, a first backfill of history after the chat write path has
+already recorded newer activity, and write-path turns committed more than
+once (a retry after a commit that landed, then a journal replay). Exits
+non-zero on any mismatch.
+"""
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+from benchmarks import fakes
+
+
+def add_messages(repository, db, conversation_id, user_id, timestamps):
+    repository.conversation_ref(db, conversation_id).set({'user_id': user_id})
+    for timestamp in timestamps:
+        repository.messages_ref(db, conversation_id).document().set(
+            {'role': 'user', 'content': 'hello', 'timestamp': timestamp})
+
+
+def concurrent_runs(modules):
+    """Two runs racing over 50 messages count each message once"""
+    rollups, repository, _ = modules
+    db = fakes.FakeFirestore(latency=0.002)
+    start = datetime.now(timezone.utc) - timedelta(hours=1)
+    add_messages(repository, db, 'race', 'student', [start + timedelta(seconds=i) for i in range(50)])
+
+    counted = []
+    runs = [threading.Thread(target=lambda: counted.append(rollups.run_incremental(db, page_size=10)))
+            for _ in range(2)]
+    for run in runs:
+        run.start()
+    for run in runs:
+        run.join()
+    rollup = repository.get_user_rollups(db)['student']
+    return {'message_count': (rollup['message_count'], 50), 'messages counted by runs': (sum(counted), 50)}
+
+
+def backfill_after_write_path(modules):
+    """History older than write-path activity still yields its sessions and minutes"""
+    rollups, repository, persistence = modules
+    db = fakes.FakeFirestore()
+    now = datetime.now(timezone.utc)
+    start = now - timedelta(days=1)
+    add_messages(repository, db, 'history', 'student',
+                 [start + timedelta(minutes=minutes) for minutes in (0, 5, 10, 120, 125, 130)])
+    persistence.MessageWriter(db).write_now([persistence.new_job(
+        db, 'live', 'student', [{'role': 'user', 'content': 'hello', 'timestamp': now}], new_conversation=True)])
+
+    counted = rollups.run_incremental(db)
+    rollup = repository.get_user_rollups(db)['student']
+    return {
+        'messages counted': (counted, 6),
+        'sessions': (rollup['sessions'], 3),
+        'active_minutes': (rollup.get('active_minutes'), 20.0),
+        'last_active': (rollup['last_active'], now),
+    }
+
+
+def retried_commit(modules):
+    """A turn whose commit landed but reported an error is counted once across retry and replay"""
+    _, repository, persistence = modules
+    db = fakes.FakeFirestore()
+    writer = persistence.MessageWriter(db, base_backoff=0)
+    now = datetime.now(timezone.utc)
+    job = persistence.new_job(db, 'retried', 'student', [
+        {'role': 'user', 'content': 'hello', 'timestamp': now},
+        {'role': 'assistant', 'content': 'hi', 'timestamp': now + timedelta(seconds=5)}
+    ], new_conversation=True)
+
+    transaction = db.transaction
+    failed = []
+
+    def flaky_transaction():
+        flaky = transaction()
+        commit = flaky.commit
+
+        def commit_then_fail():
+            commit()
+            if not failed:
+                failed.append(True)
+                raise persistence.api_exceptions.DeadlineExceeded("Deadline exceeded after commit")
+        flaky.commit = commit_then_fail
+        return flaky
+
+    db.transaction = flaky_transaction
+    writer._commit([job])
+    db.transaction = transaction
+    writer.write_now([job])
+
+    rollup = repository.get_user_rollups(db)['student']
+    return {
+        'message_count': (rollup['message_count'], 2),
+        'sessions': (rollup['sessions'], 1),
+        'duplicates skipped': (writer.stats['duplicates'], 2),
+    }
+
+
+def main():
+    fakes.install()
+    import persistence
+    import repository
+    import rollups
+    modules = (rollups, repository, persistence)
+
+    failures = 0
+    for check in (concurrent_runs, backfill_after_write_path, retried_commit):
+        for name, (actual, expected) in check(modules).items():
+            ok = actual == expected
+            failures += not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {check.__name__}: {name} = {actual} (expected {expected})")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""Compact storage for long message bodies.
+
+Messages whose content exceeds `COMPRESS_THRESHOLD` characters keep only a
+short preview in `content`; the full text is held zlib-compressed in
+`content_z`, both in Firestore and in `st.session_state.messages`. Use
+`message_text` wherever the full body is needed (display, LLM context,
+analytics); it inflates lazily and caches recent bodies.
+"""
+import zlib
+from functools import lru_cache
+
+COMPRESS_THRESHOLD = 2000  # Characters; shorter bodies are stored as-is
+PREVIEW_CHARS = 300
+
+
+def deflate(text):
+    return zlib.compress(text.encode('utf-8'), 6)
+
+
+@lru_cache(maxsize=128)
+def inflate(data):
+    return zlib.decompress(data).decode('utf-8')
+
+
+def preview(text, limit=PREVIEW_CHARS):
+    """Leading slice of a long body, cut at a word boundary"""
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + " …"
+
+
+def compact(message):
+    """Return the message with a long body swapped for preview + compressed bytes"""
+    content = message.get('content')
+    if not isinstance(content, str) or len(content) <= COMPRESS_THRESHOLD:
+        return message
+    return {
+        **message,
+        'content': preview(content),
+        'content_z': deflate(content),
+        'content_encoding': 'zlib',
+        'content_length': len(content)
+    }
+
+
+def message_text(message):
+    """Full body of a message, inflating it if it was stored compressed"""
+    data = message.get('content_z')
+    if data:
+        return inflate(bytes(data))
+    return message.get('content') or ''
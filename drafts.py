@@ -0,0 +1,113 @@
+"""Essay draft versioning for incremental reviews.
+
+Each essay reviewed in a conversation is stored as a version in
+`conversations/{id}/drafts/{version}` with its compressed text, a bottom-k
+shingle fingerprint and the per-criterion scores parsed from the review.
+When a student pastes a revision of the latest draft, only the changed
+paragraphs and the prior scores are sent to the model. Drafts are read with
+`repository.latest_draft`.
+"""
+import difflib
+import hashlib
+import re
+
+from compression import deflate, inflate
+
+MIN_ESSAY_WORDS = 150       # Shorter review requests are not treated as drafts
+REVISION_SIMILARITY = 0.3   # Estimated shingle overlap that marks a revision
+MAX_CHANGED_SHARE = 0.6     # Past this share of rewritten paragraphs, review in full
+FINGERPRINT_SIZE = 64
+SHINGLE_WORDS = 5
+
+CRITERIA = ["Grasp of Field", "Research & Methodology", "Structure"]
+_CRITERION_SCORE = re.compile(r"(" + "|".join(re.escape(c) for c in CRITERIA) + r")\s*\(\[?(\d+)\]?\s*/\s*(\d+)\)")
+_TOTAL_SCORE = re.compile(r"Total Score:\s*\[?(\d+)\s*/\s*100")
+
+
+def word_count(text):
+    return len(text.split())
+
+
+def paragraphs(text):
+    """Non-empty paragraphs, split on blank lines (or lines if there are none)"""
+    parts = re.split(r"\n\s*\n", text.strip())
+    if len(parts) == 1:
+        parts = text.strip().splitlines()
+    return [" ".join(part.split()) for part in parts if part.strip()]
+
+
+def fingerprint(text, size=FINGERPRINT_SIZE):
+    """Bottom-k sketch of the hashed word shingles of a text"""
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    hashes = {int.from_bytes(hashlib.blake2b(s.encode(), digest_size=7).digest(), 'big') for s in shingles}
+    return sorted(hashes)[:size]
+
+
+def similarity(a, b, size=FINGERPRINT_SIZE):
+    """Estimated Jaccard similarity of two fingerprints"""
+    if not a or not b:
+        return 0.0
+    union = sorted(set(a) | set(b))[:size]
+    return len(set(union) & set(a) & set(b)) / len(union)
+
+
+def parse_scores(review):
+    """Per-criterion and total scores from a review in the REVIEW_INSTRUCTIONS template"""
+    scores = {name: int(score) for name, score, _ in _CRITERION_SCORE.findall(review or '')}
+    total = _TOTAL_SCORE.search(review or '')
+    if total:
+        scores['Total'] = int(total.group(1))
+    return scores
+
+
+def new_draft(text, version, scores):
+    """Draft document for Firestore and the session cache"""
+    return {
+        'version': version,
+        'text_z': deflate(text),
+        'fingerprint': fingerprint(text),
+        'word_count': word_count(text),
+        'scores': scores
+    }
+
+
+def find_revision(previous, text):
+    """Changed sections if `text` revises the `previous` draft, else None"""
+    if not previous or not previous.get('scores'):
+        return None
+    if similarity(previous.get('fingerprint'), fingerprint(text)) < REVISION_SIMILARITY:
+        return None
+
+    old = paragraphs(inflate(bytes(previous['text_z'])))
+    new = paragraphs(text)
+    changes = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if tag != 'equal':
+            changes.append({'type': tag, 'before': old[i1:i2], 'after': new[j1:j2], 'position': j1 + 1})
+    if sum(len(change['after']) for change in changes) > MAX_CHANGED_SHARE * len(new):
+        return None
+    return changes
+
+
+def incremental_review_prompt(previous, changes, total_paragraphs):
+    """User message describing only what changed since the last reviewed draft"""
+    scores = "\n".join(f"- {name}: {score}" for name, score in previous['scores'].items())
+    lines = [
+        f"This is a revision of draft {previous['version']} ({previous.get('word_count', '?')} words), "
+        f"which was already reviewed. The revision has {total_paragraphs} paragraphs.",
+        "",
+        "Previous scores:",
+        scores,
+        ""
+    ]
+    if not changes:
+        lines.append("No paragraphs changed since the previous draft.")
+    for change in changes:
+        lines.append(f"## Change at paragraph {change['position']} ({change['type']})")
+        if change['before']:
+            lines += ["Before:", *change['before']]
+        if change['after']:
+            lines += ["After:", *change['after']]
+        lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,222 @@
+"""Listener-backed conversation lists for the sidebar and admin pages.
+
+With `EWA_LIVE_VIEWS=1`, each user's conversation metadata is kept in an
+in-process `ConversationView`, fed by a Firestore `on_snapshot` listener and
+updated incrementally from its change events, so reruns read titles and
+ordering from memory instead of querying. Views are shared across sessions
+in the process and reference-counted: every session holds a lease, and the
+listener is torn down when the last lease is released, either explicitly or
+when the session's state is garbage collected. Collected leases only queue
+their release (the collector can run anywhere, including inside the
+registry's lock); queued releases are applied on the next registry call.
+
+Only the first start of a listener is waited on. If it doesn't deliver a
+snapshot in time (or fails to start), callers fall back to queries at once
+while the listener is restarted in the background.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from datetime import datetime, timezone
+import streamlit as st
+
+import repository
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('EWA_LIVE_VIEWS') == '1'
+READY_TIMEOUT = 2.0    # Seconds to wait for a new listener's first snapshot
+RETRY_INTERVAL = 30.0  # Minimum seconds between restarts of a stalled listener
+
+_OLDEST = datetime.min.replace(tzinfo=timezone.utc)
+
+
+class ConversationView:
+    """One user's conversations, maintained from listener change events"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.watch = None
+        self.error = None
+        self.attempts = 0
+        self._db = None
+        self._started_at = None
+        self._restarting = False
+        self._closed = False
+        self._docs = {}
+        self._ordered = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, db):
+        self._db = db
+        self.attempts += 1
+        self._started_at = time.monotonic()
+        try:
+            self.watch = repository.watch_conversations(db, self.user_id, self._on_snapshot)
+        except Exception as e:
+            self.error = e
+            logger.warning("Conversation listener for %s failed to start: %s", self.user_id, e)
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._closed = True
+            watch, self.watch = self.watch, None
+        if watch is not None:
+            watch.unsubscribe()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def restart_in_background(self):
+        """Replace a listener that hasn't delivered, at most once per RETRY_INTERVAL"""
+        with self._lock:
+            if self._closed or self._restarting or self.ready:
+                return
+            if time.monotonic() - self._started_at < max(READY_TIMEOUT, RETRY_INTERVAL * (self.attempts - 1)):
+                return
+            self._restarting = True
+        threading.Thread(target=self._restart, name=f'view-restart-{self.user_id}', daemon=True).start()
+
+    def _restart(self):
+        try:
+            with self._lock:
+                watch, self.watch = self.watch, None
+            if watch is not None:
+                watch.unsubscribe()
+            self.error = None
+            self.start(self._db)
+            with self._lock:
+                # Released while restarting: don't leave the new listener running
+                orphan = self.watch if self._closed else None
+            if orphan is not None:
+                orphan.unsubscribe()
+        finally:
+            self._restarting = False
+
+    def _on_snapshot(self, snapshots, changes, read_time):
+        with self._lock:
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    self._docs.pop(change.document.id, None)
+                else:
+                    self._docs[change.document.id] = change.document
+            self._ordered = None
+        self._ready.set()
+
+    def wait_ready(self, timeout=READY_TIMEOUT):
+        """Wait for the first snapshot, but only within the first start's timeout"""
+        if self.ready:
+            return True
+        if self.error is not None or self.attempts > 1:
+            return False
+        remaining = timeout - (time.monotonic() - self._started_at)
+        return remaining > 0 and self._ready.wait(remaining)
+
+    def conversations(self):
+        """Snapshots of the user's conversations, most recently updated first"""
+        with self._lock:
+            if self._ordered is None:
+                self._ordered = sorted(self._docs.values(), reverse=True,
+                                       key=lambda doc: doc.to_dict().get('updated_at') or _OLDEST)
+            return list(self._ordered)
+
+    def page(self, page, page_size=10):
+        """One page of conversations and whether another page follows"""
+        conversations = self.conversations()
+        start = page * page_size
+        return conversations[start:start + page_size], len(conversations) > start + page_size
+
+
+class ViewLease:
+    """A session's claim on a shared view; released once, explicitly or on collection"""
+
+    def __init__(self, registry, view):
+        self.view = view
+        self.user_id = view.user_id
+        self._registry = registry
+        self._finalizer = weakref.finalize(self, registry._pending.append, view.user_id)
+
+    @property
+    def released(self):
+        return not self._finalizer.alive
+
+    def release(self):
+        self._finalizer()
+        self._registry.drain()
+
+
+class ViewRegistry:
+    """Process-wide reference-counted conversation views"""
+
+    def __init__(self):
+        self.stats = Counter()
+        self._views = {}
+        self._refs = Counter()
+        self._lock = threading.Lock()
+        # Released user ids; appended by lease finalizers without taking the lock
+        self._pending = deque()
+
+    def acquire(self, db, user_id):
+        """Lease the user's view, starting its listener if this is the first lease"""
+        self.drain()
+        with self._lock:
+            view = self._views.get(user_id)
+            if view is None:
+                view = self._views[user_id] = ConversationView(user_id)
+                self.stats['listeners_started'] += 1
+                start = True
+            else:
+                start = False
+            self._refs[user_id] += 1
+        if start:
+            view.start(db)
+        return ViewLease(self, view)
+
+    def _release(self, user_id):
+        with self._lock:
+            self._refs[user_id] -= 1
+            if self._refs[user_id] > 0:
+                return
+            del self._refs[user_id]
+            view = self._views.pop(user_id, None)
+            self.stats['listeners_stopped'] += 1
+        if view is not None:
+            view.stop()
+
+    def drain(self):
+        """Apply releases queued by lease finalizers"""
+        while True:
+            try:
+                user_id = self._pending.popleft()
+            except IndexError:
+                return
+            self._release(user_id)
+
+    def active(self):
+        self.drain()
+        with self._lock:
+            return len(self._views)
+
+
+views = ViewRegistry()
+
+
+def session_view(db, user_id, key='conversation_view'):
+    """The user's live view, leased by this session under `key`; None if it isn't ready"""
+    views.drain()
+    lease = st.session_state.get(key)
+    if lease is None or lease.released or lease.user_id != user_id:
+        if lease is not None:
+            lease.release()
+        lease = views.acquire(db, user_id)
+        st.session_state[key] = lease
+    if lease.view.wait_ready():
+        return lease.view
+    lease.view.restart_in_background()
+    return None
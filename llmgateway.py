@@ -0,0 +1,278 @@
+"""Process-wide gateway for OpenAI chat completions.
+
+All completions go through one `LLMGateway`, which
+- admits requests through a fair scheduler: weighted round-robin across
+  lanes (chat, review, title) and round-robin across sessions within a lane,
+  with review turns capped so they can't take every slot from chat turns,
+- paces them with token buckets sized to the account's RPM/TPM quotas,
+- retries 429s, timeouts and 5xx with jittered backoff, honouring
+  `Retry-After` and pausing every caller while the API asks us to back off,
+- optionally hedges short requests by firing a duplicate when the first is
+  slower than the lane's recent p95 latency (never sooner than
+  `hedge_delay`) and keeping whichever answers first. A hedge takes its own
+  scheduler slot, and is skipped when no slot is free, while paused for a
+  429, or when either quota bucket is running low.
+"""
+import random
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import openai
+from openai import OpenAI
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError,
+                    openai.APIConnectionError, openai.InternalServerError)
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `rate_per_minute`"""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Tokens that could be taken right now"""
+        with self._lock:
+            return min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+
+    def acquire(self, amount=1, timeout=None):
+        """Take `amount` tokens, sleeping until they are available"""
+        amount = min(amount, self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                needed = (amount - self.tokens) / self.rate
+            if deadline is not None and now + needed > deadline:
+                raise TimeoutError("Rate limit wait exceeded timeout")
+            time.sleep(min(needed, 1.0))
+
+
+class FairScheduler:
+    """Concurrency slots shared fairly across lanes and sessions"""
+
+    def __init__(self, max_concurrent=16, weights=None, lane_limits=None):
+        self.max_concurrent = max_concurrent
+        self.weights = weights or {'chat': 4, 'review': 2, 'title': 1}
+        self.lane_limits = lane_limits or {'review': max(1, max_concurrent // 2)}
+        self._order = [lane for lane, weight in self.weights.items() for _ in range(weight)]
+        self._position = 0
+        self._waiting = {lane: OrderedDict() for lane in self.weights}
+        self._active = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, lane, session_id, timeout=None):
+        """Hold one concurrency slot for the duration of the block"""
+        ticket = threading.Event()
+        with self._lock:
+            self._waiting.setdefault(lane, OrderedDict()).setdefault(session_id, deque()).append(ticket)
+            self._dispatch()
+        if not ticket.wait(timeout):
+            with self._lock:
+                if not ticket.is_set():
+                    self._remove(lane, session_id, ticket)
+                    raise TimeoutError("Timed out waiting for an LLM slot")
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def try_acquire(self, lane):
+        """Take a free slot without queueing; refused while anyone is waiting"""
+        with self._lock:
+            if (self._active['total'] >= self.max_concurrent or any(self._waiting.values())
+                    or self._active[lane] >= self.lane_limits.get(lane, self.max_concurrent)):
+                return False
+            self._active[lane] += 1
+            self._active['total'] += 1
+            return True
+
+    def release(self, lane):
+        with self._lock:
+            self._active[lane] -= 1
+            self._active['total'] -= 1
+            self._dispatch()
+
+    def _remove(self, lane, session_id, ticket):
+        tickets = self._waiting[lane].get(session_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._waiting[lane][session_id]
+
+    def _eligible(self, lane):
+        limit = self.lane_limits.get(lane, self.max_concurrent)
+        return self._waiting.get(lane) and self._active[lane] < limit
+
+    def _dispatch(self):
+        """Hand free slots to waiters; caller holds the lock"""
+        while self._active['total'] < self.max_concurrent:
+            lanes = self._order + [lane for lane in self._waiting if lane not in self.weights]
+            for step in range(len(lanes)):
+                lane = lanes[(self._position + step) % len(lanes)]
+                if self._eligible(lane):
+                    self._position = (self._position + step + 1) % len(lanes)
+                    break
+            else:
+                return
+            # Round-robin across sessions: serve the oldest, then rotate it to the back
+            sessions = self._waiting[lane]
+            session_id, tickets = next(iter(sessions.items()))
+            ticket = tickets.popleft()
+            sessions.pop(session_id)
+            if tickets:
+                sessions[session_id] = tickets
+            self._active[lane] += 1
+            self._active['total'] += 1
+            ticket.set()
+
+
+class LLMGateway:
+    """Rate-limited, retrying and optionally hedging chat completion client"""
+
+    def __init__(self, api_key, rpm=500, tpm=200000, max_concurrent=16, max_retries=4,
+                 base_backoff=1.0, max_backoff=30.0, hedge_delay=2.5, hedge_max_tokens=500,
+                 hedge_percentile=0.95, hedge_min_samples=20, hedge_headroom=0.25,
+                 request_timeout=120.0, queue_timeout=60.0, weights=None, lane_limits=None):
+        self.client = OpenAI(api_key=api_key, max_retries=0, timeout=request_timeout)
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.scheduler = FairScheduler(max_concurrent, weights, lane_limits)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.hedge_delay = hedge_delay
+        self.hedge_max_tokens = hedge_max_tokens
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_headroom = hedge_headroom
+        self.queue_timeout = queue_timeout
+        self.stats = Counter()
+        self._paused_until = 0.0
+        self._latencies = defaultdict(lambda: deque(maxlen=200))  # Recent successful request seconds per lane
+        self._lock = threading.Lock()
+        self._hedges = ThreadPoolExecutor(max_workers=max_concurrent * 2, thread_name_prefix='llm')
+
+    def complete(self, lane='chat', session_id=None, hedge=False, **kwargs):
+        """Create a chat completion; `kwargs` go to `chat.completions.create`"""
+        with self.scheduler.slot(lane, session_id, timeout=self.queue_timeout):
+            attempt = 0
+            while True:
+                try:
+                    if hedge and kwargs.get('max_tokens', 0) <= self.hedge_max_tokens:
+                        return self._hedged(lane, kwargs)
+                    return self._send(lane, kwargs)
+                except RETRYABLE_ERRORS as e:
+                    if attempt >= self.max_retries:
+                        self.stats['exhausted'] += 1
+                        raise
+                    self.stats['retries'] += 1
+                    self._backoff(e, attempt)
+                    attempt += 1
+
+    def _send(self, lane, kwargs):
+        """Wait for quota, then make a single request"""
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        estimate = len(str(kwargs.get('messages', ''))) // 4 + kwargs.get('max_tokens', 0)
+        self.requests.acquire(1)
+        self.tokens.acquire(estimate)
+        self.stats['requests'] += 1
+        started = time.monotonic()
+        response = self.client.chat.completions.create(**kwargs)
+        with self._lock:
+            self._latencies[lane].append(time.monotonic() - started)
+        return response
+
+    def hedge_delay_for(self, lane):
+        """Seconds before hedging a `lane` request, or None until enough latencies are known"""
+        with self._lock:
+            samples = sorted(self._latencies[lane])
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_delay, samples[int(self.hedge_percentile * (len(samples) - 1))])
+
+    def _can_hedge(self):
+        """Whether there is quota to spare for a duplicate request"""
+        if time.monotonic() < self._paused_until:
+            return False
+        return (self.requests.available() >= self.hedge_headroom * self.requests.capacity
+                and self.tokens.available() >= self.hedge_headroom * self.tokens.capacity)
+
+    def _hedged(self, lane, kwargs):
+        """Send a second copy if the first is slow and return whichever wins"""
+        delay = self.hedge_delay_for(lane)
+        first = self._hedges.submit(self._send, lane, kwargs)
+        if delay is None:
+            return first.result()
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        # The duplicate holds a scheduler slot of its own until both copies finish
+        if not self._can_hedge() or not self.scheduler.try_acquire(lane):
+            self.stats['hedges_skipped'] += 1
+            return first.result()
+        self.stats['hedges'] += 1
+        second = self._hedges.submit(self._send, lane, kwargs)
+        in_flight = [2]
+
+        def finished(future):
+            with self._lock:
+                in_flight[0] -= 1
+                last = in_flight[0] == 0
+            if last:
+                self.scheduler.release(lane)
+
+        first.add_done_callback(finished)
+        second.add_done_callback(finished)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self.stats['hedge_wins'] += 1
+                    return future.result()
+        # Both failed; surface the original request's error
+        return first.result()
+
+    def _backoff(self, error, attempt):
+        """Sleep before a retry, honouring Retry-After when the API sends one"""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            self.stats['rate_limited'] += 1
+            # Everyone pauses, not just this caller, while we're over quota
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            delay = retry_after + random.uniform(0, self.base_backoff)
+        else:
+            delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        time.sleep(delay)
+
+
+def _retry_after(error):
+    """Seconds requested by a Retry-After(-ms) header, if any"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
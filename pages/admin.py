@@ -2,7 +2,24 @@ import streamlit as st
 from firebase_admin import firestore, auth
 from datetime import datetime
 import pytz
-import pandas as pd
+
+from analytics import DISPLAY_COLUMNS, load_conversation_frame, summarize_sessions, summarize_spans
+from rollups import recent_days, run_incremental
+import repository
+import liveviews
+from tracing import JsonlSink, tracer
+
+ADMIN_CACHE_TTL = 300  # Seconds a role lookup is reused before re-checking
+
+@st.cache_data(ttl=ADMIN_CACHE_TTL, show_spinner=False)
+def lookup_admin_role(uid, email):
+    """Look up whether a user has the admin role, cached per uid"""
+    db = firestore.client()
+    user = repository.get_user(db, uid, fields=['role'])
+    if user is None:
+        # Fall back to documents not keyed by uid
+        user = repository.find_user_by_email(db, email, fields=['role'])
+    return bool(user) and user.get('role') == 'admin'
 
 class AdminDashboard:
     def __init__(self):
@@ -30,29 +47,6 @@ class AdminDashboard:
             st.session_state.selected_conversations = all_ids
         st.session_state.show_batch_delete = len(st.session_state.selected_conversations) > 0
 
-    def get_last_login_from_chat(self, user_id):
-        """Get user's last login time from their most recent chat message"""
-        try:
-            # Only get the most recent conversation using orderBy and limit(1)
-            latest_conv = self.db.collection('conversations')\
-                .where('user_id', '==', user_id)\
-                .order_by('updated_at', direction=firestore.Query.DESCENDING)\
-                .limit(1)\
-                .stream()
-        
-            # Convert to list to check if any conversations exist
-            latest_conv = list(latest_conv)
-            if not latest_conv:
-                return None
-
-            # Use the updated_at timestamp from the conversation document
-            conv_data = latest_conv[0].to_dict()
-            return conv_data.get('updated_at')
-
-        except Exception as e:
-            st.error(f"Error getting last login: {e}")
-            return None
-
     def create_user_document(self, user):
         """Create or update user document in Firestore"""
         try:
@@ -62,7 +56,7 @@ class AdminDashboard:
                 'created_at': firestore.SERVER_TIMESTAMP                
             }
             
-            self.db.collection('users').document(user.uid).set(user_data)
+            repository.set_user(self.db, user.uid, user_data)
             return True
         except Exception as e:
             st.error(f"Error creating user document: {e}")
@@ -75,35 +69,44 @@ class AdminDashboard:
             synced_count = 0
             
             for auth_user in auth_users:
-                user_doc = self.db.collection('users').document(auth_user.uid).get()
+                user_data = repository.get_user(self.db, auth_user.uid, fields=['role'])
                 
-                if not user_doc.exists:
+                if user_data is None:
                     self.create_user_document(auth_user)
                     synced_count += 1
+                    
+                # Mirror the Firestore role into a custom claim so admin
+                # checks don't need a query
+                is_admin = bool(user_data) and user_data.get('role') == 'admin'
+                claims = dict(auth_user.custom_claims or {})
+                if bool(claims.get('admin')) != is_admin:
+                    claims['admin'] = is_admin
+                    auth.set_custom_user_claims(auth_user.uid, claims)
             
             return synced_count
         except Exception as e:
             st.error(f"Error syncing users: {e}")
             return 0
             
-    def check_admin_access(self, email):
-        """Check if user has admin privileges"""
+    def check_admin_access(self, user):
+        """Check if user has admin privileges.
+
+        Uses the `admin` custom claim when the session's user record carries
+        one, otherwise a role lookup cached per uid for a few minutes.
+        """
+        claims = getattr(user, 'custom_claims', None) or {}
+        if 'admin' in claims:
+            return bool(claims['admin'])
         try:
-            user_ref = self.db.collection('users').where('email', '==', email).limit(1).get()
-            if not user_ref:
-                return False
-            user_data = user_ref[0].to_dict()
-            return user_data.get('role') == 'admin'
+            return lookup_admin_role(user.uid, user.email)
         except Exception as e:
             st.error(f"Error checking admin access: {e}")
             return False
     
     def delete_conversation(self, conversation_id):
-        """Delete a single conversation and all its messages"""
+        """Delete a single conversation with its messages and drafts"""
         try:
-            messages_ref = self.db.collection('conversations').document(conversation_id).collection('messages')
-            self._batch_delete(messages_ref)
-            self.db.collection('conversations').document(conversation_id).delete()
+            repository.delete_conversation(self.db, conversation_id)
             return True
         except Exception as e:
             st.error(f"Error deleting conversation: {e}")
@@ -112,9 +115,8 @@ class AdminDashboard:
     def delete_user_conversations(self, user_id):
         """Delete all conversations for a specific user"""
         try:
-            conversations = self.db.collection('conversations').where('user_id', '==', user_id).stream()
-            for conv in conversations:
-                self.delete_conversation(conv.id)
+            for conversation_id in repository.user_conversation_ids(self.db, user_id):
+                self.delete_conversation(conversation_id)
             return True
         except Exception as e:
             st.error(f"Error deleting user conversations: {e}")
@@ -130,15 +132,13 @@ class AdminDashboard:
             st.error(f"Error deleting conversations: {e}")
             return False
 
-    def _batch_delete(self, collection_ref, batch_size=100):
-        """Helper method to delete collection in batches"""
-        docs = collection_ref.limit(batch_size).stream()
-        deleted = 0
-        for doc in docs:
-            doc.reference.delete()
-            deleted += 1
-        if deleted >= batch_size:
-            return self._batch_delete(collection_ref, batch_size)
+    def get_user_conversations(self, user_id):
+        """A user's conversations, newest first, from the live view when enabled"""
+        if liveviews.ENABLED:
+            view = liveviews.session_view(self.db, user_id, key='admin_conversation_view')
+            if view is not None:
+                return view.conversations()
+        return repository.list_conversations(self.db, user_id)
 
     def format_timestamp(self, timestamp):
         """Helper method to format timestamp consistently"""
@@ -149,6 +149,85 @@ class AdminDashboard:
                 return 'N/A'
         return 'N/A'
     
+    def render_session_analytics(self, conversations, frames):
+        """Render per-session charts computed from the conversation frames"""
+        summary = summarize_sessions(frames)
+        if summary.empty:
+            return
+
+        titles = {conv.id: conv.to_dict().get('title', 'Untitled') for conv in conversations}
+        summary = summary.rename(index=titles)
+
+        st.subheader("Session Analytics")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Sessions", len(summary))
+        with col2:
+            st.metric("Avg Turns per Session", f"{summary['turns'].mean():.1f}")
+        with col3:
+            st.metric("Avg Session Length (min)", f"{summary['duration_minutes'].mean():.1f}")
+
+        st.bar_chart(summary[['turns']])
+        st.bar_chart(summary[['duration_minutes']])
+
+    def render_engagement(self, users):
+        """Render cohort engagement from the precomputed rollup documents"""
+        st.subheader("Engagement (Last 7 Days)")
+        days = repository.get_daily_rollups(self.db, recent_days(7))
+        not_started = [user['email'] for user in users if not user['messages']]
+        active_users = set().union(*(day.get('active_users', []) for day in days))
+        sessions = sum(day.get('sessions', 0) for day in days)
+        active_minutes = sum(day.get('active_minutes', 0) for day in days)
+
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Not Started", len(not_started))
+        with col2:
+            st.metric("Active This Week", len(active_users))
+        with col3:
+            st.metric("Avg Session Length (min)", f"{active_minutes / sessions:.1f}" if sessions else "N/A")
+
+        if days:
+            st.bar_chart({
+                'Messages': {day['date']: day.get('message_count', 0) for day in days},
+                'Review Requests': {day['date']: day.get('review_requests', 0) for day in days}
+            })
+
+        started = [user for user in users if user['sessions']]
+        if started:
+            st.caption("Per student, all time")
+            st.bar_chart({
+                'Messages': {user['email']: user['messages'] for user in started},
+                'Sessions': {user['email']: user['sessions'] for user in started}
+            })
+            st.bar_chart({
+                'Avg Session Length (min)': {user['email']: round(user['active_minutes'] / user['sessions'], 1)
+                                             for user in started}
+            })
+        if not_started:
+            with st.expander(f"Users who haven't started ({len(not_started)})"):
+                st.write(", ".join(not_started))
+
+    def render_performance(self, batches=50):
+        """Render latency percentiles and token usage from the configured metrics sink"""
+        st.subheader("Performance")
+        if not st.toggle("Show performance metrics", key="show_performance"):
+            return
+
+        if isinstance(tracer.sink, JsonlSink):
+            events = tracer.sink.recent(limit=batches * tracer.flush_size)
+            source = f"the end of {tracer.sink.path} (this host only)"
+        else:
+            events = repository.recent_metric_batches(self.db, limit=batches)
+            source = f"the last {batches} flushes"
+        summary = summarize_spans(events)
+        if summary.empty:
+            st.info("No metrics recorded yet.")
+            return
+
+        st.caption(f"{len(events)} spans from {source}")
+        st.dataframe(summary, hide_index=True, use_container_width=True)
+
     def render_dashboard(self):
         st.title("Admin Dashboard")
         
@@ -160,10 +239,16 @@ class AdminDashboard:
             else:
                 st.info("All users are already synced")
         
+        if st.button("Refresh Engagement Rollups", key="refresh_rollups_btn"):
+            try:
+                processed = run_incremental(self.db)
+                st.success(f"Rolled up {processed} new messages")
+            except Exception as e:
+                st.error(f"Error refreshing rollups: {e}")
+
         # Get counts for metrics
-        users_count = len(list(self.db.collection('users').get()))
-        convs = list(self.db.collection('conversations').get())
-        convs_count = len(convs)
+        users_count = repository.count_users(self.db)
+        convs_count = repository.count_conversations(self.db)
         
         # Display metrics
         col1, col2 = st.columns(2)
@@ -171,24 +256,29 @@ class AdminDashboard:
             st.metric("Total Users", users_count)
         with col2:
             st.metric("Total Conversations", convs_count)
+
+        self.render_performance()
                
         # User Management
         st.subheader("User Management")
-        users_ref = self.db.collection('users').stream()
+        users_ref = repository.list_users(self.db)
+        rollups = repository.get_user_rollups(self.db)
         users = []
 
         # Process users with proper error handling
         for doc in users_ref:
             user_data = doc.to_dict()
-    
-            # Get last login from chat history
-            last_login = self.get_last_login_from_chat(doc.id)
+            rollup = rollups.get(doc.id, {})
     
             users.append({
                 "id": doc.id,
                 "email": user_data.get('email', 'N/A'),
                 "role": user_data.get('role', 'N/A'),
-                "last_login": self.format_timestamp(last_login)
+                "last_login": self.format_timestamp(rollup.get('last_active')),
+                "messages": rollup.get('message_count', 0),
+                "review_requests": rollup.get('review_requests', 0),
+                "sessions": rollup.get('sessions', 0),
+                "active_minutes": round(rollup.get('active_minutes', 0))
         })
         
          # Create user table with processed data
@@ -196,8 +286,12 @@ class AdminDashboard:
             st.table({
                 'Email': [user['email'] for user in users],
                 'Role': [user['role'] for user in users],
-                'Last Active': [user['last_login'] for user in users]
+                'Last Active': [user['last_login'] for user in users],
+                'Messages': [user['messages'] for user in users],
+                'Review Requests': [user['review_requests'] for user in users],
+                'Active Minutes': [user['active_minutes'] for user in users]
             })
+            self.render_engagement(users)
         else:
             st.info("No users found in the database.")
         
@@ -230,10 +324,14 @@ class AdminDashboard:
                         st.warning("Are you sure? Click again to confirm deletion of ALL conversations.")
 
                 # Get conversations
-                conversations = list(self.db.collection('conversations')
-                                  .where('user_id', '==', selected_user['id'])
-                                  .order_by('updated_at', direction=firestore.Query.DESCENDING)
-                                  .stream())
+                conversations = self.get_user_conversations(selected_user['id'])
+
+                # Load each conversation as a cached columnar frame
+                frames = {
+                    conv.id: load_conversation_frame(conv.id, str(conv.to_dict().get('updated_at')))
+                    for conv in conversations
+                }
+                self.render_session_analytics(conversations, frames)
 
                 # Show batch operations controls in a fixed position
                 if st.session_state.show_batch_delete:
@@ -280,52 +378,10 @@ class AdminDashboard:
                     
                     with col2:
                         with st.expander(f"View Essay: {conv_title}", expanded=True):
-                            messages = self.db.collection('conversations').document(conv.id)\
-                                      .collection('messages')\
-                                      .order_by('timestamp')\
-                                      .stream()
-                            
-                            detailed_data = []
-                            prev_msg_time = None
-                            
-                            for msg in messages:
-                                msg_data = msg.to_dict()
-                                timestamp = msg_data.get('timestamp')
-                                
-                                if timestamp:
-                                    date = timestamp.astimezone(self.tz).strftime('%Y-%m-%d')
-                                    time = timestamp.astimezone(self.tz).strftime('%H:%M:%S')
-                                    
-                                    if prev_msg_time:
-                                        curr_seconds = int(time.split(':')[0]) * 3600 + \
-                                                     int(time.split(':')[1]) * 60 + \
-                                                     int(time.split(':')[2])
-                                        prev_seconds = int(prev_msg_time.split(':')[0]) * 3600 + \
-                                                     int(prev_msg_time.split(':')[1]) * 60 + \
-                                                     int(prev_msg_time.split(':')[2])
-                                        response_time = curr_seconds - prev_seconds
-                                    else:
-                                        response_time = 'N/A'
-                                        
-                                    prev_msg_time = time
-                                else:
-                                    date = 'N/A'
-                                    time = 'N/A'
-                                    response_time = 'N/A'
-                                    
-                                content = msg_data.get('content', '')
-                                word_count = len(content.split()) if content else 0
-                                
-                                detailed_data.append({
-                                    'date': date,
-                                    'time': time,
-                                    'role': msg_data.get('role', 'N/A'),
-                                    'content': content,
-                                    'length': word_count,
-                                    'response_time': response_time
-                                })
+                            frame = frames[conv.id]
+                            detailed_data = frame[DISPLAY_COLUMNS]
                             
-                            if detailed_data:
+                            if not detailed_data.empty:
                                 st.dataframe(
                                     detailed_data,
                                     column_config={
@@ -349,8 +405,7 @@ class AdminDashboard:
                                 # Create columns for buttons at the bottom
                                 col1, col2 = st.columns([5,1])
                                 with col1:
-                                    df = pd.DataFrame(detailed_data)
-                                    csv = df.to_csv(index=False).encode('utf-8')
+                                    csv = detailed_data.to_csv(index=False).encode('utf-8')
                                     st.download_button(
                                         label="Download Chat Log as CSV",
                                         data=csv,
@@ -377,7 +432,7 @@ def main():
         return
         
     admin = AdminDashboard()
-    if not admin.check_admin_access(st.session_state.user.email):
+    if not admin.check_admin_access(st.session_state.user):
         st.error("Access denied. Admin privileges required.")
         return
         
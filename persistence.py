@@ -0,0 +1,335 @@
+"""Write-behind persistence for chat messages.
+
+`MessageWriter` accepts whole chat turns into a bounded in-memory queue and
+returns immediately. A worker thread coalesces queued turns into Firestore
+transactions (messages, conversation metadata and engagement rollups),
+retrying transient commit failures with jittered exponential backoff, then
+refreshes conversation titles. Every committed turn leaves a marker document
+read by the next commit, so a retried or replayed turn is never counted twice. A batch that fails permanently (or runs out of
+attempts) is split to isolate the bad turn, which is set aside as a dead
+letter so the rest keep draining. With a `journal_path`, queued turns are
+also kept in a local SQLite journal until committed and replayed after a
+restart, and dead letters are kept there for inspection and `requeue_dead_letters`.
+"""
+import base64
+import json
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+from google.api_core import exceptions as api_exceptions
+
+from rollups import RollupBatch
+import repository
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+MARKER_TTL = timedelta(days=7)  # How long applied-turn markers are kept (TTL policy on `expire_at`)
+
+TRANSIENT_ERRORS = (api_exceptions.ServiceUnavailable, api_exceptions.DeadlineExceeded,
+                    api_exceptions.InternalServerError, api_exceptions.Aborted,
+                    api_exceptions.ResourceExhausted, ConnectionError, TimeoutError)
+
+
+def new_job(db, conversation_id, user_id, messages, new_conversation=False, previous=None, context="",
+            documents=None):
+    """Build a queued turn; message ids are fixed up front so retries are idempotent.
+
+    `documents` are extra (subcollection, id, data) writes under the
+    conversation committed in the same batch, e.g. essay drafts.
+    """
+    messages_ref = repository.messages_ref(db, conversation_id)
+    return {
+        'id': uuid.uuid4().hex,
+        'conversation_id': conversation_id,
+        'user_id': user_id,
+        'new_conversation': new_conversation,
+        'messages': [{'id': messages_ref.document().id, 'data': dict(msg)} for msg in messages],
+        'previous': previous,
+        'context': context,
+        'documents': [list(document) for document in documents or []],
+        'queued_at': time.time()
+    }
+
+
+def _encode(job):
+    def default(value):
+        if isinstance(value, bytes):
+            return {'$bytes': base64.b64encode(value).decode('ascii')}
+        return {'$datetime': value.isoformat()}
+    return json.dumps(job, default=default)
+
+
+def _decode(payload):
+    def hook(obj):
+        if set(obj) == {'$datetime'}:
+            return datetime.fromisoformat(obj['$datetime'])
+        if set(obj) == {'$bytes'}:
+            return base64.b64decode(obj['$bytes'])
+        return obj
+    return json.loads(payload, object_hook=hook)
+
+
+class Journal:
+    """SQLite journal of turns that are queued but not yet committed"""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS pending (id TEXT PRIMARY KEY, payload TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS dead_letters "
+                           "(id TEXT PRIMARY KEY, payload TEXT NOT NULL, error TEXT, failed_at REAL)")
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO pending VALUES (?, ?)", (job['id'], _encode(job)))
+
+    def remove(self, jobs):
+        with self._lock:
+            self._conn.executemany("DELETE FROM pending WHERE id = ?", [(job['id'],) for job in jobs])
+
+    def pending(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT payload FROM pending ORDER BY rowid").fetchall()
+        return [_decode(payload) for payload, in rows]
+
+    def dead_letter(self, job, error):
+        """Move a turn that can't be committed out of the pending table"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?)",
+                               (job['id'], _encode(job), str(error), time.time()))
+            self._conn.execute("DELETE FROM pending WHERE id = ?", (job['id'],))
+            self._conn.execute("COMMIT")
+
+    def dead_letters(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT payload FROM dead_letters ORDER BY rowid").fetchall()
+        return [_decode(payload) for payload, in rows]
+
+    def discard_dead_letters(self, jobs):
+        with self._lock:
+            self._conn.executemany("DELETE FROM dead_letters WHERE id = ?", [(job['id'],) for job in jobs])
+
+
+@firestore.transactional
+def _commit_turns(transaction, db, jobs):
+    """Write the turns not committed before, with their rollups; returns the ones written.
+
+    Each turn leaves a marker document in the same transaction, so a retry
+    after a commit that landed but reported an error (or a journal replay)
+    finds the marker and skips the turn instead of counting it twice.
+    """
+    applied = repository.get_applied_turns(db, [job['id'] for job in jobs], transaction=transaction)
+    jobs = [job for job in jobs if job['id'] not in applied]
+    rollup = RollupBatch(db)
+    for job in jobs:
+        conv_ref = repository.conversation_ref(db, job['conversation_id'])
+        conversation = {'updated_at': firestore.SERVER_TIMESTAMP}
+        if job['new_conversation']:
+            started = job['messages'][0]['data']['timestamp']
+            conversation.update({
+                'user_id': job['user_id'],
+                'created_at': firestore.SERVER_TIMESTAMP,
+                'title': f"{started.strftime('%b %d, %Y')} • New Chat [{len(job['messages'])}📝]",
+                'status': 'active'
+            })
+        transaction.set(conv_ref, conversation, merge=True)
+
+        if job['user_id'] not in rollup.previous and job['previous']:
+            rollup.previous[job['user_id']] = job['previous']
+        for message in job['messages']:
+            transaction.set(repository.messages_ref(db, job['conversation_id']).document(message['id']),
+                            {**message['data'], 'rolled_up': True})
+            rollup.add(job['user_id'], message['data'], message['data']['timestamp'])
+        for collection, document_id, data in job.get('documents', []):
+            transaction.set(conv_ref.collection(collection).document(document_id), data)
+        transaction.set(repository.applied_turn_ref(db, job['id']), {
+            'conversation_id': job['conversation_id'],
+            'applied_at': firestore.SERVER_TIMESTAMP,
+            'expire_at': datetime.now(timezone.utc) + MARKER_TTL
+        })
+    rollup.write(transaction)
+    return jobs
+
+
+class MessageWriter:
+    """Bounded write-behind queue with a single batching worker thread"""
+
+    def __init__(self, db, title_fn=None, maxsize=1000, batch_size=50, max_wait=0.2,
+                 put_timeout=2.0, base_backoff=0.5, max_backoff=30.0, max_attempts=6,
+                 journal_path=None, title_workers=4):
+        self.db = db
+        self.title_fn = title_fn
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.put_timeout = put_timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.journal = Journal(journal_path) if journal_path else None
+        self.stats = {'jobs': 0, 'batches': 0, 'retries': 0, 'fallbacks': 0, 'dead_letters': 0,
+                      'duplicates': 0, 'last_error': None}
+        self._queue = queue.Queue(maxsize=maxsize)
+        # Titles need an LLM call each, so they run beside the commit loop
+        self._titles = ThreadPoolExecutor(max_workers=title_workers, thread_name_prefix='title')
+        self._title_futures = set()
+        self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, job):
+        """Queue a turn for persistence.
+
+        Blocks for up to `put_timeout` when the queue is full, then falls
+        back to committing the turn synchronously so it is never dropped.
+        """
+        if self.journal:
+            self.journal.add(job)
+        try:
+            self._queue.put(job, timeout=self.put_timeout)
+        except queue.Full:
+            self.stats['fallbacks'] += 1
+            self.write_now([job])
+            self._finish([job])
+
+    def pending(self):
+        """Number of turns waiting to be committed"""
+        return self._queue.unfinished_tasks
+
+    def flush(self, timeout=None):
+        """Wait until every queued turn is committed and titled; returns True if drained"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        return not wait(list(self._title_futures), timeout=remaining).not_done
+
+    def write_now(self, jobs):
+        """Commit turns in one Firestore transaction and schedule their title refresh"""
+        queued_ms = (time.time() - min(job['queued_at'] for job in jobs)) * 1000
+        with span('firestore.write_batch', turns=len(jobs), queued_ms=queued_ms):
+            applied = _commit_turns(self.db.transaction(), self.db, jobs)
+        self.stats['jobs'] += len(applied)
+        self.stats['duplicates'] += len(jobs) - len(applied)
+        self.stats['batches'] += 1
+        self._update_titles(jobs)
+
+    def _update_titles(self, jobs):
+        """Schedule a title refresh for each conversation touched by the batch"""
+        if not self.title_fn:
+            return
+        latest = {job['conversation_id']: job for job in jobs}
+        for conversation_id, job in latest.items():
+            future = self._titles.submit(self._update_title, conversation_id, job)
+            self._title_futures.add(future)
+            future.add_done_callback(self._title_futures.discard)
+
+    def _update_title(self, conversation_id, job):
+        """Summarise a conversation into a short title with its message count"""
+        try:
+            with span('firestore.count_messages'):
+                count = repository.count_messages(self.db, conversation_id)
+            summary = self.title_fn(job['context'])
+            day = job['messages'][-1]['data']['timestamp'].strftime('%b %d, %Y')
+            with span('firestore.update_title'):
+                repository.conversation_ref(self.db, conversation_id).set({'title': f"{day} • {summary} [{count}📝]"}, merge=True)
+        except Exception as e:
+            # A stale title is harmless; the messages are already stored
+            logger.warning("Title update failed for %s: %s", conversation_id, e)
+
+    def _finish(self, jobs):
+        if self.journal:
+            self.journal.remove(jobs)
+
+    def _take(self):
+        """Block for one turn, then gather more for up to `max_wait` seconds"""
+        jobs = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(jobs) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return jobs
+
+    def _run(self):
+        if self.journal:
+            for job in self.journal.pending():
+                self._queue.put(job)
+
+        while True:
+            jobs = self._take()
+            try:
+                self._commit(jobs)
+            except Exception as e:
+                # Never let the worker die; the turns stay journaled
+                logger.exception("Message writer failed on %d turns: %s", len(jobs), e)
+            for _ in jobs:
+                self._queue.task_done()
+
+    def _commit(self, jobs):
+        """Commit a batch, retrying transient errors up to `max_attempts` times.
+
+        A permanent error splits the batch in halves until the failing turn is
+        isolated; that turn, or a batch that exhausts its attempts, is dead-lettered.
+        """
+        attempt = 0
+        while True:
+            try:
+                self.write_now(jobs)
+                self._finish(jobs)
+                return
+            except TRANSIENT_ERRORS as e:
+                self.stats['last_error'] = str(e)
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    # The service is unavailable, not the turns; don't bisect
+                    self._dead_letter(jobs, e)
+                    return
+                self.stats['retries'] += 1
+                delay = min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1))
+                logger.warning("Message batch commit failed (attempt %d): %s", attempt, e)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+            except Exception as e:
+                self.stats['last_error'] = str(e)
+                if len(jobs) == 1:
+                    self._dead_letter(jobs, e)
+                    return
+                middle = len(jobs) // 2
+                self._commit(jobs[:middle])
+                self._commit(jobs[middle:])
+                return
+
+    def _dead_letter(self, jobs, error):
+        self.stats['dead_letters'] += len(jobs)
+        for job in jobs:
+            logger.error("Dropping turn %s for conversation %s after commit failure: %s",
+                         job['id'], job['conversation_id'], error)
+            if self.journal:
+                self.journal.dead_letter(job, error)
+
+    def requeue_dead_letters(self):
+        """Queue journaled dead letters for another attempt; returns how many"""
+        if not self.journal:
+            return 0
+        jobs = self.journal.dead_letters()
+        for job in jobs:
+            self.journal.add(job)
+            self._queue.put(job)
+        self.journal.discard_dead_letters(jobs)
+        return len(jobs)
@@ -0,0 +1,296 @@
+"""Firestore data access for conversations, messages, drafts, users and rollups.
+
+Every query the app and admin pages issue lives here, so the indexes they
+need can be declared in one place: `QUERY_SHAPES` lists the ordered/filtered
+queries below and `firestore.indexes.json` must cover them (check with
+`python -m benchmarks.indexcheck`). List views use projections so only the
+fields they display are read.
+"""
+import json
+from pathlib import Path
+from firebase_admin import firestore
+
+from tracing import METRICS_COLLECTION
+
+CONVERSATIONS = 'conversations'
+MESSAGES = 'messages'
+DRAFTS = 'drafts'
+USERS = 'users'
+USER_ROLLUPS = 'user_rollups'
+DAILY_ROLLUPS = 'daily_rollups'
+ROLLUP_STATE = 'rollup_state'
+APPLIED_TURNS = 'applied_turns'
+
+CONVERSATION_LIST_FIELDS = ['title', 'updated_at']
+USER_LIST_FIELDS = ['email', 'role']
+# Projecting to the document name reads ids only; an empty projection returns every field
+ID_ONLY = ['__name__']
+INDEX_MANIFEST = Path(__file__).resolve().parent / 'firestore.indexes.json'
+
+# (collection group, query scope, [(field, order)]) for each query below;
+# no fields means an unfiltered scan, which needs no index
+QUERY_SHAPES = [
+    (CONVERSATIONS, 'COLLECTION', [('user_id', 'ASCENDING'), ('updated_at', 'DESCENDING')]),
+    (CONVERSATIONS, 'COLLECTION', [('user_id', 'ASCENDING')]),
+    (MESSAGES, 'COLLECTION', [('timestamp', 'ASCENDING')]),
+    (MESSAGES, 'COLLECTION_GROUP', [('timestamp', 'ASCENDING')]),
+    (DRAFTS, 'COLLECTION', [('version', 'DESCENDING')]),
+    (USERS, 'COLLECTION', [('email', 'ASCENDING')]),
+    (METRICS_COLLECTION, 'COLLECTION', [('created_at', 'DESCENDING')]),
+    (USER_ROLLUPS, 'COLLECTION', []),
+]
+
+
+# Conversations
+
+def conversation_ref(db, conversation_id):
+    return db.collection(CONVERSATIONS).document(conversation_id)
+
+
+def new_conversation_id(db):
+    """Allocate a conversation id locally, without a round trip"""
+    return db.collection(CONVERSATIONS).document().id
+
+
+def list_conversations(db, user_id, limit=None, offset=0, fields=CONVERSATION_LIST_FIELDS):
+    """A user's conversations, most recently updated first, projected to `fields`"""
+    query = db.collection(CONVERSATIONS)\
+        .where('user_id', '==', user_id)\
+        .order_by('updated_at', direction=firestore.Query.DESCENDING)
+    if fields is not None:
+        query = query.select(fields)
+    if offset:
+        query = query.offset(offset)
+    if limit:
+        query = query.limit(limit)
+    return list(query.stream())
+
+
+def conversation_page(db, user_id, page, page_size=10):
+    """One sidebar page of conversations and whether another page follows"""
+    convs = list_conversations(db, user_id, limit=page_size + 1, offset=page * page_size)
+    return convs[:page_size], len(convs) > page_size
+
+
+def user_conversation_ids(db, user_id):
+    """Ids of every conversation owned by a user, without reading their fields"""
+    query = db.collection(CONVERSATIONS).where('user_id', '==', user_id).select(ID_ONLY)
+    return [doc.id for doc in query.stream()]
+
+
+def watch_conversations(db, user_id, callback):
+    """Listen to a user's conversations; `callback(snapshots, changes, read_time)`"""
+    return db.collection(CONVERSATIONS).where('user_id', '==', user_id).on_snapshot(callback)
+
+
+def get_conversations(db, conversation_ids):
+    """Fetch several conversation documents in one round trip"""
+    refs = [conversation_ref(db, conversation_id) for conversation_id in conversation_ids]
+    return list(db.get_all(refs)) if refs else []
+
+
+def count_conversations(db):
+    return db.collection(CONVERSATIONS).count().get()[0][0].value
+
+
+def delete_conversation(db, conversation_id, batch_size=400):
+    """Delete a conversation with its messages and drafts, in write batches"""
+    conv_ref = conversation_ref(db, conversation_id)
+    for subcollection in (MESSAGES, DRAFTS):
+        while True:
+            docs = list(conv_ref.collection(subcollection).select(ID_ONLY).limit(batch_size).stream())
+            if not docs:
+                break
+            batch = db.batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            batch.commit()
+            if len(docs) < batch_size:
+                break
+    conv_ref.delete()
+
+
+# Messages
+
+def messages_ref(db, conversation_id):
+    return conversation_ref(db, conversation_id).collection(MESSAGES)
+
+
+def get_messages(db, conversation_id):
+    """A conversation's messages as dicts, oldest first"""
+    query = messages_ref(db, conversation_id).order_by('timestamp')
+    return [doc.to_dict() for doc in query.stream()]
+
+
+def count_messages(db, conversation_id):
+    return messages_ref(db, conversation_id).count().get()[0][0].value
+
+
+def messages_since(db, watermark=None, start_after=None, limit=200):
+    """Messages across all conversations newer than `watermark`, oldest first"""
+    query = db.collection_group(MESSAGES)
+    if watermark:
+        query = query.where('timestamp', '>', watermark)
+    query = query.order_by('timestamp')
+    if start_after:
+        query = query.start_after(start_after)
+    return list(query.limit(limit).stream())
+
+
+# Drafts
+
+def latest_draft(db, conversation_id):
+    """Most recent essay draft stored for a conversation, or None"""
+    drafts = conversation_ref(db, conversation_id).collection(DRAFTS)\
+        .order_by('version', direction=firestore.Query.DESCENDING)\
+        .limit(1)\
+        .get()
+    return drafts[0].to_dict() if drafts else None
+
+
+# Users
+
+def user_ref(db, uid):
+    return db.collection(USERS).document(uid)
+
+
+def get_user(db, uid, fields=None):
+    """A user document as a dict, or None"""
+    doc = user_ref(db, uid).get(field_paths=fields)
+    return doc.to_dict() if doc.exists else None
+
+
+def find_user_by_email(db, email, fields=None):
+    """The first user document with this email, or None"""
+    query = db.collection(USERS).where('email', '==', email)
+    if fields is not None:
+        query = query.select(fields)
+    docs = query.limit(1).get()
+    return docs[0].to_dict() if docs else None
+
+
+def set_user(db, uid, data):
+    user_ref(db, uid).set(data)
+
+
+def list_users(db, fields=USER_LIST_FIELDS):
+    """All user documents, projected to `fields`"""
+    return list(db.collection(USERS).select(fields).stream())
+
+
+def count_users(db):
+    return db.collection(USERS).count().get()[0][0].value
+
+
+# Rollups
+
+def user_rollup_ref(db, user_id):
+    return db.collection(USER_ROLLUPS).document(user_id)
+
+
+def daily_rollup_ref(db, day):
+    return db.collection(DAILY_ROLLUPS).document(day)
+
+
+def rollup_state_ref(db):
+    return db.collection(ROLLUP_STATE).document('messages')
+
+
+def get_user_rollups(db):
+    """All per-user rollup documents keyed by user id"""
+    return {doc.id: doc.to_dict() for doc in db.collection(USER_ROLLUPS).stream()}
+
+
+def get_last_active(db, user_ids):
+    """Last recorded activity for each of `user_ids` that has any"""
+    refs = [user_rollup_ref(db, user_id) for user_id in user_ids]
+    docs = db.get_all(refs, field_paths=['last_active']) if refs else []
+    return {doc.id: doc.get('last_active') for doc in docs
+            if doc.exists and doc.to_dict().get('last_active')}
+
+
+def get_daily_rollups(db, days):
+    """Daily rollup documents for the given `YYYY-MM-DD` keys, oldest first"""
+    refs = [daily_rollup_ref(db, day) for day in days]
+    return sorted((doc.to_dict() for doc in db.get_all(refs) if doc.exists),
+                  key=lambda day: day['date'])
+
+
+def get_rollup_watermark(db, transaction=None):
+    """Timestamp of the last message rolled up by the batch job, or None"""
+    state = rollup_state_ref(db).get(transaction=transaction)
+    return state.to_dict().get('watermark') if state.exists else None
+
+
+# Write-behind markers
+
+def applied_turn_ref(db, job_id):
+    return db.collection(APPLIED_TURNS).document(job_id)
+
+
+def get_applied_turns(db, job_ids, transaction=None):
+    """Which of `job_ids` already have a commit marker"""
+    refs = [applied_turn_ref(db, job_id) for job_id in job_ids]
+    docs = db.get_all(refs, transaction=transaction) if refs else []
+    return {doc.id for doc in docs if doc.exists}
+
+
+# Metrics
+
+def recent_metric_batches(db, limit=50):
+    """Span events from the most recent tracing flushes"""
+    docs = db.collection(METRICS_COLLECTION)\
+        .order_by('created_at', direction=firestore.Query.DESCENDING)\
+        .limit(limit)\
+        .stream()
+    return [event for doc in docs for event in doc.to_dict().get('events', [])]
+
+
+# Index manifest
+
+def load_index_manifest(path=INDEX_MANIFEST):
+    with open(path) as f:
+        return json.load(f)
+
+
+def missing_indexes(manifest, shapes=QUERY_SHAPES):
+    """Query shapes that `manifest` does not serve; empty when every query is covered.
+
+    Multi-field shapes need a matching composite index. Single-field shapes
+    are served automatically for collection scope unless a field override
+    drops that order; collection-group scope has to be enabled explicitly.
+    """
+    composites = {
+        (index['collectionGroup'], index.get('queryScope', 'COLLECTION'),
+         tuple((field['fieldPath'], field.get('order')) for field in index['fields']))
+        for index in manifest.get('indexes', [])
+    }
+    overrides = {(override['collectionGroup'], override['fieldPath']): override['indexes']
+                 for override in manifest.get('fieldOverrides', [])}
+
+    missing = []
+    for group, scope, fields in shapes:
+        if len(fields) > 1:
+            if (group, scope, tuple(fields)) not in composites:
+                missing.append((group, scope, fields))
+            continue
+        if not fields:
+            continue
+        (field, order), = fields
+        indexes = overrides.get((group, field))
+        if indexes is None:
+            covered = scope == 'COLLECTION'
+        else:
+            covered = any(index.get('order') == order and index.get('queryScope', 'COLLECTION') == scope
+                          for index in indexes)
+        if not covered:
+            missing.append((group, scope, fields))
+    return missing
+
+
+def unused_indexes(manifest, shapes=QUERY_SHAPES):
+    """Composite indexes in `manifest` that no query shape uses"""
+    used = {(group, scope, tuple(fields)) for group, scope, fields in shapes}
+    return [index for index in manifest.get('indexes', [])
+            if (index['collectionGroup'], index.get('queryScope', 'COLLECTION'),
+                tuple((field['fieldPath'], field.get('order')) for field in index['fields'])) not in used]
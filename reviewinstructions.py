@@ -206,3 +206,9 @@ REVIEW_INSTRUCTIONS = """As you review the essay, please follow these steps and
 Is there any specific area you would like me to elaborate further?"""
 
 
+
+INCREMENTAL_REVIEW_INSTRUCTIONS = """The student has revised an essay you already reviewed. You are given the previous per-criterion scores and only the paragraphs that changed (before and after), not the full essay.
+- Re-assess only the criteria the changes affect; carry forward the previous scores for the rest
+- Comment on whether each change addresses earlier suggestions, quoting the revised text
+- Keep the same Review Template structure, with updated scores and the total
+- Do not ask for the full essay unless the changes cannot be judged without it"""
@@ -0,0 +1,188 @@
+"""Incremental engagement rollups.
+
+Per-user (`user_rollups/{uid}`) and per-day (`daily_rollups/{YYYY-MM-DD}`)
+documents hold message counts, review requests, sessions, active minutes and
+last activity. They are updated from the chat write path in the same
+transaction as the messages themselves (see persistence.py), and by
+`run_incremental` for anything written without them (history, older clients).
+The batch job only reads messages newer than the watermark stored in
+`rollup_state/messages`; it needs a collection-group index on
+`messages.timestamp` (declared in firestore.indexes.json).
+
+Run as a scheduled job with `python rollups.py`.
+"""
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+import pytz
+from firebase_admin import firestore
+
+from compression import message_text
+import repository
+
+logger = logging.getLogger(__name__)
+
+REVIEW_KEYWORDS = ["grade", "score", "review", "assess", "evaluate", "feedback", "rubric"]
+IDLE_GAP = timedelta(minutes=30)  # Longer gaps start a new session
+TZ = pytz.timezone("Europe/London")
+
+
+def is_review_request(prompt):
+    """Check a student prompt for review/scoring related keywords"""
+    prompt = (prompt or '').lower()
+    return any(keyword in prompt for keyword in REVIEW_KEYWORDS)
+
+
+def day_key(timestamp):
+    """Daily rollup document id for a timestamp"""
+    return timestamp.astimezone(TZ).strftime('%Y-%m-%d')
+
+
+class RollupBatch:
+    """Accumulate rollup increments and write them as one set of merges"""
+
+    def __init__(self, db, previous=None, stored_last_active=None):
+        self.db = db
+        # Last known activity per user, used for active minutes and sessions
+        self.previous = previous if previous is not None else {}
+        # `last_active` already stored per user; never written backwards
+        self.stored_last_active = stored_last_active if stored_last_active is not None else {}
+        self.users = defaultdict(Counter)
+        self.days = defaultdict(Counter)
+        self.day_users = defaultdict(set)
+        self.last_active = {}
+
+    def add(self, user_id, message, timestamp):
+        """Count one message sent at `timestamp` by or to `user_id`"""
+        counts = Counter(message_count=1)
+        if message.get('role') == 'user' and is_review_request(message_text(message)):
+            counts['review_requests'] = 1
+
+        # Activity later than this message (e.g. a backfill seeded from a
+        # last_active the write path already moved on) says nothing about the
+        # gap before it, so the message starts a session
+        previous = self.previous.get(user_id)
+        if previous is None or timestamp < previous or timestamp - previous > IDLE_GAP:
+            counts['sessions'] = 1
+        else:
+            counts['active_minutes'] = (timestamp - previous).total_seconds() / 60
+
+        day = day_key(timestamp)
+        self.users[user_id].update(counts)
+        self.days[day].update(counts)
+        self.day_users[day].add(user_id)
+
+        # Chain gaps through the messages being counted
+        self.previous[user_id] = timestamp
+        if user_id not in self.last_active or timestamp > self.last_active[user_id]:
+            self.last_active[user_id] = timestamp
+
+    def write(self, batch):
+        """Add the accumulated increments to a Firestore write batch or transaction"""
+        for user_id, counts in self.users.items():
+            update = {key: firestore.Increment(value) for key, value in counts.items() if value}
+            last_active = self.last_active.get(user_id)
+            stored = self.stored_last_active.get(user_id)
+            if last_active and (stored is None or last_active > stored):
+                update['last_active'] = self.stored_last_active[user_id] = last_active
+            update['updated_at'] = firestore.SERVER_TIMESTAMP
+            batch.set(repository.user_rollup_ref(self.db, user_id), update, merge=True)
+
+        for day, counts in self.days.items():
+            update = {key: firestore.Increment(value) for key, value in counts.items() if value}
+            update['date'] = day
+            update['active_users'] = firestore.ArrayUnion(sorted(self.day_users[day]))
+            update['updated_at'] = firestore.SERVER_TIMESTAMP
+            batch.set(repository.daily_rollup_ref(self.db, day), update, merge=True)
+
+
+class WatermarkMoved(Exception):
+    """Another run advanced the rollup watermark while this one was reading"""
+
+
+@firestore.transactional
+def _commit_page(transaction, db, rollup, expected, watermark):
+    """Write a page's increments and advance the watermark, if it hasn't moved"""
+    if repository.get_rollup_watermark(db, transaction) != expected:
+        raise WatermarkMoved()
+    rollup.write(transaction)
+    transaction.set(repository.rollup_state_ref(db), {
+        'watermark': watermark,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }, merge=True)
+
+
+def run_incremental(db, page_size=200):
+    """Roll up messages newer than the stored watermark.
+
+    Messages already counted on the write path (`rolled_up`) are skipped.
+    Each page is committed in a transaction together with the advanced
+    watermark, so an interrupted run resumes where it stopped, and a run
+    that finds the watermark moved by a concurrent run stops instead of
+    counting the same messages twice. Returns the number of messages counted
+    by this run (not those already rolled up on the write path).
+    """
+    watermark = repository.get_rollup_watermark(db)
+    expected = watermark  # Watermark our next page commit must still find
+    owners = {}     # conversation id -> user id
+    previous = {}   # user id -> last activity seen, for session gaps
+    stored = {}     # user id -> last_active stored in the user's rollup
+    seeded = set()
+    processed = 0
+    last_doc = None
+
+    while True:
+        docs = repository.messages_since(db, watermark, start_after=last_doc, limit=page_size)
+        if not docs:
+            break
+
+        # Resolve message owners through their parent conversations
+        conv_ids = {doc.reference.parent.parent.id for doc in docs} - set(owners)
+        for conv in repository.get_conversations(db, conv_ids):
+            owners[conv.id] = conv.to_dict().get('user_id') if conv.exists else None
+
+        # Seed last activity for users seen for the first time in this run
+        new_users = {user_id for user_id in owners.values() if user_id and user_id not in seeded}
+        stored.update(repository.get_last_active(db, new_users))
+        previous.update({user_id: stored[user_id] for user_id in new_users if user_id in stored})
+        seeded |= new_users
+
+        rollup = RollupBatch(db, previous, stored)
+        counted = 0
+        for doc in docs:
+            data = doc.to_dict()
+            user_id = owners.get(doc.reference.parent.parent.id)
+            if user_id and data.get('timestamp') and not data.get('rolled_up'):
+                rollup.add(user_id, data, data['timestamp'])
+                counted += 1
+
+        last_doc = docs[-1]
+        try:
+            _commit_page(db.transaction(), db, rollup, expected, last_doc.get('timestamp'))
+        except WatermarkMoved:
+            logger.info("Rollup watermark moved by a concurrent run; stopping after %d messages", processed)
+            break
+        expected = last_doc.get('timestamp')
+
+        processed += counted
+        if len(docs) < page_size:
+            break
+
+    return processed
+
+
+def recent_days(days=7):
+    """Daily rollup keys for the last `days` days, today included"""
+    today = datetime.now(TZ)
+    return [day_key(today - timedelta(days=offset)) for offset in range(days)]
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials
+    import streamlit as st
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(dict(st.secrets["FIREBASE"])))
+    count = run_incremental(firestore.client())
+    print(f"Rolled up {count} messages")
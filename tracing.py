@@ -0,0 +1,156 @@
+"""Lightweight per-turn latency and token tracing.
+
+Wrap work in `span(name, **attrs)`; finished spans are kept in an in-process
+buffer and flushed in batches by a background thread, either to the
+`metrics` Firestore collection (one document per flush) or, when
+`EWA_METRICS_FILE` is set, to a local JSONL file. The admin performance panel
+reads back from whichever sink is configured.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from firebase_admin import firestore
+
+METRICS_COLLECTION = 'metrics'
+
+
+class FirestoreSink:
+    """Write each flushed batch of spans as one `metrics` document"""
+
+    def __init__(self, collection=METRICS_COLLECTION):
+        self.collection = collection
+
+    def write(self, events):
+        firestore.client().collection(self.collection).add({
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'host': os.environ.get('HOSTNAME', ''),
+            'events': events
+        })
+
+
+class JsonlSink:
+    """Append spans to a local JSONL file, one span per line"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, events):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps(event, default=str) + "\n")
+
+    def recent(self, limit=5000):
+        """The last `limit` spans in the file, oldest first"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                lines = deque(f, maxlen=limit)
+        except FileNotFoundError:
+            return []
+        events = []
+        for line in lines:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A line still being appended by another process
+                continue
+        return events
+
+
+class Tracer:
+    """Collect spans in memory and flush them in batches off the request path"""
+
+    def __init__(self, sink, flush_size=100, flush_interval=30.0, max_buffer=5000):
+        self.sink = sink
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time a block; the yielded dict can be updated with more attributes"""
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record({
+                'name': name,
+                'ts': datetime.now(timezone.utc).isoformat(),
+                'duration_ms': (time.perf_counter() - start) * 1000,
+                **({'error': error} if error else {}),
+                **attrs
+            })
+
+    def record(self, event):
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                # Never let a stuck sink grow memory without bound
+                self.dropped += 1
+                return
+            self._buffer.append(event)
+            full = len(self._buffer) >= self.flush_size
+        self._ensure_worker()
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Write out everything buffered so far"""
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        if not events:
+            return
+        try:
+            self.sink.write(events)
+        except Exception:
+            # Metrics are best effort; put the batch back for the next flush
+            with self._lock:
+                self._buffer = (events + self._buffer)[-self.max_buffer:]
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='tracer-flush', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+def usage_attrs(response):
+    """Token usage attributes from a chat completion response"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return {}
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'prompt_tokens': usage.prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        'cached_tokens': getattr(details, 'cached_tokens', None) or 0
+    }
+
+
+def _default_sink():
+    path = os.environ.get('EWA_METRICS_FILE')
+    return JsonlSink(path) if path else FirestoreSink()
+
+
+tracer = Tracer(_default_sink())
+span = tracer.span
+atexit.register(tracer.flush)